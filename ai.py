@@ -1,8 +1,11 @@
 import math
+import time
 import pymunk
 from pymunk import Vec2d
 import gameobjects
 import boxmodels
+import occupancy
+import pathfinding
 from collections import defaultdict, deque
 
 # 3 degrees, a bit more than we can turn each tick
@@ -23,6 +26,191 @@ def periodic_difference_of_angles(angle1, angle2):
     return  ((angle1% (2*math.pi)) - (angle2% (2*math.pi))) % (2*math.pi)
 
 
+def first_hit_in_front(tank, space, currentmap):
+    """ 
+    Makes a raycast query in front of the tank and returns the game object
+    that is hit first, or None if nothing is hit.
+    """
+    angle = tank.body.angle + math.pi/2
+    start = tank.body.position + (math.cos(angle)*0.4, math.sin(angle)*0.4)
+    end = tank.body.position + (math.cos(angle)*currentmap.width,\
+          math.sin(angle)*currentmap.height)
+
+    res = space.segment_query_first(start, end, 0, pymunk.ShapeFilter())
+    if hasattr(res, "shape") and hasattr(res.shape, "parent"):
+        return res.shape.parent
+    return None
+
+
+class Targeting:
+    """ 
+    Line of sight checks shared by all the ai tanks. The hit of a tank is
+    reused while it stays within a small tolerance of the position and
+    heading it was made from, for at most max_age ticks, and while the
+    object hit is still in entities, the entities.EntityRegistry of the
+    game, if given.
+    """
+
+    def __init__(self, space, currentmap, position_tolerance = 0.05,
+                 angle_tolerance = math.radians(1), max_age = 10,
+                 entities = None):
+        self.space              = space
+        self.currentmap         = currentmap
+        self.entities           = entities
+        self.position_tolerance = position_tolerance
+        self.angle_tolerance    = angle_tolerance
+        self.max_age            = max_age
+        self.tick               = 0
+        self.hits               = {}
+
+        # Number of raycasts made in the current and the previous tick
+        self.raycasts           = 0
+        self.raycasts_per_tick  = 0
+
+
+    def aim_all(self, ai_list):
+        """ 
+        Starts a new tick and makes the line of sight checks for every ai
+        tank that is able to fire, in one pass. Call this once per tick,
+        before the ai tanks decide.
+        """
+        self.tick += 1
+        self.raycasts_per_tick = self.raycasts
+        self.raycasts = 0
+        for ai_tank in ai_list:
+            if ai_tank.tank.cooldown == 0:
+                self.first_hit(ai_tank.tank)
+
+
+    def first_hit(self, tank):
+        """ Returns what is in front of the tank, see first_hit_in_front. """
+        position = tank.body.position
+        angle = tank.body.angle
+        cached = self.hits.get(tank)
+        if cached != None:
+            cached_position, cached_angle, tick, target = cached
+            if self.tick - tick <= self.max_age \
+                and position.get_distance(cached_position) \
+                    <= self.position_tolerance \
+                and abs(angle - cached_angle) <= self.angle_tolerance \
+                and self.still_there(target):
+                return target
+
+        self.raycasts += 1
+        target = first_hit_in_front(tank, self.space, self.currentmap)
+        self.hits[tank] = (position, angle, self.tick, target)
+        return target
+
+
+    def still_there(self, target):
+        """ False if the object hit has been destroyed since. """
+        if target == None or self.entities == None:
+            return True
+        return self.entities.alive(target)
+
+
+class AiRegistry:
+    """ 
+    The ai tanks of the game, iterated in the order they were added.
+    Adding and removing an ai takes constant time.
+    """
+
+    def __init__(self):
+        self.ais = {}
+
+
+    def add(self, ai_tank):
+        """ Registers the ai. """
+        self.ais[ai_tank] = None
+
+
+    def remove(self, ai_tank):
+        """ Unregisters the ai. """
+        del self.ais[ai_tank]
+
+
+    def __contains__(self, ai_tank):
+        return ai_tank in self.ais
+
+
+    def __iter__(self):
+        return iter(self.ais)
+
+
+    def __len__(self):
+        return len(self.ais)
+
+
+class AiScheduler:
+    """ 
+    Lets the ai tanks decide within a time budget per tick. Flag carriers
+    go first and the others take turns being first. Once the budget is
+    used up the remaining tanks only steer (see Ai.steer), and the first
+    of them goes first on the next tick. Path planning in progress is
+    continued on the following ticks. With a budget of None there is no
+    time limit, so the decisions do not depend on the speed of the computer.
+    """
+
+    def __init__(self, budget_ms = 4, profiler = None):
+        """ Each ai is timed by the profiler, a profiler.TickProfiler. """
+        self.budget_ms  = budget_ms
+        self.profiler   = profiler
+        self.turn       = 0
+        # The first ai that only steered on the last tick, it goes first
+        self.cut_off    = None
+        # Time in ms kept out of the budget for what is done after the
+        # deadline, the end of a search slice and the steering. It is
+        # adjusted on every tick that reaches the deadline.
+        self.margin_ms  = 0
+        # Number of ticks, and of ticks where the budget was exceeded
+        self.ticks      = 0
+        self.overruns   = 0
+        self.last_ms    = 0
+
+
+    def run(self, ai_list):
+        """ Makes every ai decide once, call this on every tick. """
+        start = time.perf_counter()
+        ai_tanks = list(ai_list)
+        deadline = None
+        if self.budget_ms != None:
+            deadline = start + (self.budget_ms - self.margin_ms) / 1000
+
+        if self.cut_off in ai_list:
+            self.turn = ai_tanks.index(self.cut_off)
+        elif ai_tanks:
+            self.turn = (self.turn + 1) % len(ai_tanks)
+        ai_tanks = ai_tanks[self.turn:] + ai_tanks[:self.turn]
+        # Sorting is stable, so the turn order is kept among the rest
+        ai_tanks.sort(key = lambda ai_tank: ai_tank.tank.flag == None)
+
+        self.cut_off = None
+        for ai_tank in ai_tanks:
+            ai_tank.deadline = deadline
+            if self.cut_off == None and deadline != None \
+                    and time.perf_counter() > deadline:
+                self.cut_off = ai_tank
+            if self.cut_off != None:
+                ai_tank.steer()
+            else:
+                ai_tank.decide()
+            if self.profiler != None:
+                self.profiler.mark_ai(ai_tank)
+
+        self.ticks += 1
+        self.last_ms = (time.perf_counter() - start) * 1000
+        if self.budget_ms == None:
+            return
+        # The margin grows by what went over, and slowly shrinks back
+        if self.last_ms > self.budget_ms:
+            self.overruns += 1
+            self.margin_ms = min(self.margin_ms + self.last_ms
+                                 - self.budget_ms, self.budget_ms / 2)
+        elif self.last_ms > self.budget_ms - self.margin_ms:
+            self.margin_ms = max(self.margin_ms - (self.budget_ms
+                                 - self.last_ms) / 10, 0)
+
+
 class Ai:
     """ 
     A simple ai that finds the shortest path to the target using 
@@ -30,20 +218,65 @@ class Ai:
     and or wooden boxes. 
     """
 
-    def __init__(self, tank, game_objects_list, tanks_list, space, currentmap):
+    def __init__(self, tank, entities, tanks_list, space, currentmap,
+                 distance_fields = None, planner = None, grid = None,
+                 targeting = None, random = None, cooldown = 50):
+        """ 
+        The bullets the tank shoots are added to entities, the
+        entities.EntityRegistry of the game.
+        If distance_fields is given, paths are read from the shared
+        pathfinding.DistanceFields instead of running our own search.
+        A planner, such as pathfinding.IncrementalPlanner,
+        pathfinding.AStarPlanner or pathfinding.PlannerPool, replaces the
+        breadth first search in find_shortest_path. The grid is the shared
+        occupancy.OccupancyGrid, a new one is made from currentmap if None.
+        With a shared Targeting the line of sight checks are cached.
+        Ties between paths of the same length in the distance fields are
+        broken with random, a random.Random, if given.
+        After a shot the tank cools down for cooldown ticks, the world
+        gives it one second of game time.
+        """
         self.tank               = tank
-        self.game_objects_list  = game_objects_list
+        self.entities           = entities
         self.tanks_list         = tanks_list
         self.space              = space
         self.currentmap         = currentmap
+        self.distance_fields    = distance_fields
+        self.planner            = planner
+        self.targeting          = targeting
+        self.random             = random
+        self.cooldown           = cooldown
+        self.grid               = grid
+        if grid == None:
+            self.grid = occupancy.OccupancyGrid(currentmap)
         self.flag = None
         self.MAX_X = currentmap.width - 1 
         self.MAX_Y = currentmap.height - 1
 
+        # Counters of how often we plan, how many tiles we search and how
+        # often a worker of the planner pool failed
+        self.replans = 0
+        self.expansions = 0
+        self.pool_failures = 0
+
+        # Set by the AiScheduler, planning waits while it has passed
+        self.deadline = None
+
+        self.reset()
+
+
+    def reset(self):
+        """ 
+        Starts over from the current position of the tank, call this after
+        the tank has been reset. The flag, the grid and the planners are
+        kept.
+        """
         self.path = deque()
-        self.move_cycle = self.move_cycle_gen()
+        self.path_target = None
+        self.path_version = None
+        self.planning = None
         self.update_grid_pos()
-
+        self.expected_tile = (self.grid_pos[0], self.grid_pos[1])
         self.move_cycle = self.move_cycle_gen()
 
 
@@ -61,32 +294,42 @@ class Ai:
         every tick of the game. 
         """
         self.maybe_shoot()
+        self.continue_planning()
+        next(self.move_cycle)
+
+
+    def steer(self):
+        """ 
+        Keeps the tank shooting and following its path, without doing any
+        path planning. Called instead of decide once the time of the tick
+        is used up.
+        """
+        self.maybe_shoot()
         next(self.move_cycle)
 
 
     def maybe_shoot(self):
         """ 
         Makes a raycast query in front of the tank. If another tank
-        or a wooden box is found, then we shoot. 
+        or a wooden box is found, then we shoot. No query is made while
+        the tank can't fire.
         """
-        angle = self.tank.body.angle + math.pi/2
-        start = self.tank.body.position + (math.cos(angle)*0.4, math.sin(angle)*0.4)
-        end = self.tank.body.position + (math.cos(angle)*self.currentmap.width,\
-              math.sin(angle)*self.currentmap.height)
+        if self.tank.cooldown != 0:
+            return
 
-        res = self.space.segment_query_first(start, end, 0, pymunk.ShapeFilter())
+        if self.targeting != None:
+            target = self.targeting.first_hit(self.tank)
+        else:
+            target = first_hit_in_front(self.tank, self.space, self.currentmap)
         
-        if hasattr(res, "shape") and hasattr(res.shape, "parent"):
-            if isinstance(res.shape.parent, gameobjects.Box):
-                if res.shape.parent.boxmodel == boxmodels.get_model(2) \
-                and self.tank.cooldown == 0:
-                    self.game_objects_list.append(self.tank.shoot(self.space))
-                    self.tank.cooldown = 50
-                        
-            elif isinstance(res.shape.parent, gameobjects.Tank) \
-            and self.tank.cooldown == 0:
-                self.game_objects_list.append(self.tank.shoot(self.space))
-                self.tank.cooldown = 50
+        if isinstance(target, gameobjects.Box):
+            if target.boxmodel == boxmodels.get_model(2):
+                self.entities.add(self.tank.shoot(self.space))
+                self.tank.cooldown = self.cooldown
+                    
+        elif isinstance(target, gameobjects.Tank):
+            self.entities.add(self.tank.shoot(self.space))
+            self.tank.cooldown = self.cooldown
 
 
     def move_cycle_gen(self):
@@ -95,17 +338,14 @@ class Ai:
         to move to our goal.
         """ 
         while True:
-            # Search for shortest path to target
-            path = self.find_shortest_path()
-            if not path:
-                # Search for shortest path to target, allow metal boxes
-                path = self.find_shortest_path(True)
-                if not path:
-                    # No path to target, try again.
-                    yield
-                    continue 
+            # Find the next step on the shortest path to target
+            next_tile = yield from self.find_next_tile()
+            if next_tile == None:
+                # No path to target, try again.
+                yield
+                continue 
             # Moves on to the next coordinte and aligns from upper left to center of coordinate.
-            next_coord = path.popleft() + (0.5, 0.5)
+            next_coord = Vec2d(next_tile[0], next_tile[1]) + (0.5, 0.5)
             yield
             
             # Get tank target angle to next position
@@ -156,58 +396,189 @@ class Ai:
             self.update_grid_pos()
             
 
+    def find_next_tile(self):
+        """ 
+        A generator that returns the next tile of the path to the target,
+        or None if the target can't be reached. The path is kept between
+        calls and only planned again when needs_replan says so. If the new
+        path takes more than one tick to plan, we keep following the
+        current path while we are still on it, or else wait for it.
+        """
+        target = self.get_target_tile()
+        target = (target[0], target[1])
+        if self.planning == None and self.needs_replan(target):
+            grid_pos = (self.grid_pos[0], self.grid_pos[1])
+            if grid_pos != self.expected_tile:
+                # We are off the path, wait for the new one where we are
+                self.path = deque()
+                self.expected_tile = grid_pos
+            self.planning = self.plan_path()
+            self.planning_start = grid_pos
+            self.planning_target = target
+            self.planning_version = self.grid.version
+            self.continue_planning()
+
+        # decide() continues the planning on every tick
+        while self.planning != None and not (self.path and \
+            (self.grid_pos[0], self.grid_pos[1]) == self.expected_tile):
+            yield
+
+        if not self.path:
+            return None
+        next_tile = self.path.popleft()
+        self.expected_tile = (int(next_tile[0]), int(next_tile[1]))
+        return self.expected_tile
+
+
+    def continue_planning(self):
+        """ Runs the path planning in progress until it yields or is done. """
+        if self.planning == None:
+            return
+        try:
+            next(self.planning)
+        except StopIteration as done:
+            self.planning = None
+            path = done.value
+            # The tile we are on, or heading to along the previous path
+            heading = self.expected_tile
+            if heading != self.planning_start:
+                # We have moved on while planning, skip to where we go.
+                tiles = [(int(x), int(y)) for x, y in path]
+                if heading in tiles:
+                    for i in range(tiles.index(heading) + 1):
+                        path.popleft()
+                else:
+                    self.path = deque()
+                    self.path_target = None
+                    return
+            self.path = path
+            self.path_target = self.planning_target
+            self.path_version = self.planning_version
+
+
+    def needs_replan(self, target):
+        """ 
+        The kept path is outdated if the target has moved, if we are not on
+        the tile we were heading for, or if a tile on the rest of the path
+        has changed. Without a path any change in the grid might open one.
+        """
+        if target != self.path_target \
+            or (self.grid_pos[0], self.grid_pos[1]) != self.expected_tile:
+            return True
+        if self.grid.version != self.path_version:
+            if not self.path:
+                return True
+            dirty = self.grid.dirty_since(self.path_version)
+            for tile in self.path:
+                if (int(tile[0]), int(tile[1])) in dirty:
+                    return True
+            self.path_version = self.grid.version
+        return False
+
+
+    def out_of_time(self):
+        """ True if the scheduler's deadline for this tick has passed. """
+        return self.deadline != None and time.perf_counter() > self.deadline
+
+
+    def plan_path(self):
+        """ 
+        A generator that returns the shortest path to the target, metal
+        boxes are only allowed if there is no other path.
+        """
+        self.replans += 1
+        # Search for shortest path to target
+        path = yield from self.search_shortest_path()
+        # A weighted planner has already considered the metal boxes
+        if not path and not isinstance(self.planner,
+                                       pathfinding.AStarPlanner):
+            # Search for shortest path to target, allow metal boxes
+            path = yield from self.search_shortest_path(True)
+        return path
+
+
     def find_shortest_path(self, allow_metal = False):
         """ 
-        A simple Breadth First Search using integer coordinates as our nodes.
-        Edges are calculated as we go, using an external function.
+        Returns the shortest path to the target as a deque of Vec2d, see
+        search_shortest_path. The search is run to the end at once.
         """
+        search = self.search_shortest_path(allow_metal)
+        try:
+            while True:
+                next(search)
+        except StopIteration as done:
+            return done.value
+
+
+    def search_shortest_path(self, allow_metal = False):
+        """ 
+        A simple Breadth First Search using integer coordinates as our nodes,
+        unless we have a planner or distance fields. The search is
+        pathfinding.search_breadth_first, the one the workers of a
+        pathfinding.PlannerPool run. This is a generator that yields between
+        ticks while we are out of time, and returns the path.
+        """
+        # Wait for our turn if the time of this tick is used up
+        while self.out_of_time():
+            yield
+
+        planner = self.planner
+        if planner == None:
+            planner = self.distance_fields
+        if isinstance(planner, pathfinding.PlannerPool):
+            path = yield from self.search_in_pool(planner, allow_metal)
+            if path != None:
+                return path
+            # The worker failed, plan in this process instead
+            planner = self.distance_fields
+        if isinstance(planner, pathfinding.DistanceFields):
+            # Build the field a slice at a time, following it is quick
+            yield from planner.prepare_field(
+                self.get_target_tile(), allow_metal, self.out_of_time
+            )
+            expansions = planner.expansions
+            path = planner.find_shortest_path(
+                self.grid_pos, self.get_target_tile(), allow_metal,
+                self.random
+            )
+            self.expansions += planner.expansions - expansions
+            return path
+        if planner != None:
+            expansions = planner.expansions
+            path = planner.find_shortest_path(
+                self.grid_pos, self.get_target_tile(), allow_metal
+            )
+            self.expansions += planner.expansions - expansions
+            return path
+
+        # Search a slice at a time, in the same way as the pool workers
+        path, expansions = yield from pathfinding.search_breadth_first(
+            self.grid, self.grid_pos, self.get_target_tile(), allow_metal,
+            self.out_of_time
+        )
+        self.expansions += expansions
+        return path
+
+
+    def search_in_pool(self, pool, allow_metal = False):
+        """ 
+        A generator that waits for a worker of the pathfinding.PlannerPool
+        to find the path, and returns it, or None if the worker failed.
+        """
+        try:
+            future = pool.submit(
+                self.grid_pos, self.get_target_tile(), allow_metal
+            )
+            while not future.done():
+                yield
+            path, expansions = future.result()
+        except Exception:
+            self.pool_failures += 1
+            return None
+        self.expansions += expansions
+        return path
+
 
-        # Get the current position.
-        start_node = (self.grid_pos[0], self.grid_pos[1])
-        
-        # Create queue and add the start position.
-        queue = deque()
-        queue.append(start_node)
-        
-        # Create a set of visited nodes.
-        visited = set()
-
-        # Create a dictionary of all tested paths
-        paths = {}
-
-        # Gets the Vec2d coordinates for the starting position.
-        paths[start_node] = [Vec2d(start_node[0], start_node[1])]
-
-        # Runs while we have a queue.
-        while queue:
-            # The position we're currently looking at
-            node = queue.popleft()  
-
-            # Check if current node is target
-            if node == self.get_target_tile():
-                # Return the path taken to the target node.
-                result = deque(paths[node])
-                result.popleft()
-                return result
-
-            # Looks at all the neighbouring coordinates
-            for neighbour in self.get_tile_neighbors(node, allow_metal):
-                if (neighbour[0], neighbour[1]) not in visited:
-
-                    # If the neighbour hasn't been visited
-                    neighbour = (neighbour[0], neighbour[1])
-                    # Add neighbour to queue and visited
-                    queue.append(neighbour) 
-                    visited.add(neighbour) 
-                    # Create a copy of paths
-                    paths[neighbour] = paths[node].copy() 
-                    # Add neighbour to paths
-                    paths[neighbour].append(Vec2d(neighbour[0], neighbour[1])) # 
-                    
-        # Returns an empty deque if no path is found
-        return deque([])
-            
-            
     def get_target_tile(self):
         """
         Returns position of the flag if we don't have it. 
@@ -227,11 +598,10 @@ class Ai:
         where it is when the Ai object is initialized.
         """
         if self.flag == None:
-        # Find the flag in the game objects list
-            for obj in self.game_objects_list:
-                if isinstance(obj, gameobjects.Flag):
-                    self.flag = obj
-                    break
+        # Find the flag among the game objects
+            for obj in self.entities.of_type(gameobjects.Flag):
+                self.flag = obj
+                break
         return self.flag
 
 
@@ -246,15 +616,13 @@ class Ai:
 
     def get_tile_neighbors(self, coord_vec, allow_metal = False):
         """ 
-        Returns all bordering grid squares of the input coordinate.
+        Returns all bordering grid squares of the input coordinate as tuples.
         A bordering square is only considered accessible if it is grass
         or a wooden box. If allow_metal is true metal boxes will be accepted.
         """
-        coord_vec = Vec2d(coord_vec[0], coord_vec[1])
+        x, y = coord_vec[0], coord_vec[1]
         # Find the coordinates of the tiles' four neighbors
-        neighbors = [
-            coord_vec + delta for delta in [(1, 0), (0, 1), (-1, 0), (0, -1)]
-        ] 
+        neighbors = [(x + 1, y), (x, y + 1), (x - 1, y), (x, y - 1)]
         if allow_metal:
             return filter(self.filter_tile_neighbors_metalbox, neighbors)
         else:
@@ -263,30 +631,16 @@ class Ai:
 
     def filter_tile_neighbors (self, coord):
         """ Checks if selected tile is either free or a wooden box. """
-        if  coord[0] <= self.MAX_X \
-            and coord[1] <= self.MAX_Y \
-            and coord[0] >= 0 \
-            and coord[1] >= 0 \
-            and (self.currentmap.boxAt(coord[0], coord[1]) == 0
-            or self.currentmap.boxAt(coord[0], coord[1]) == 2):
-
-            return True
-        else:
-            return False
+        x, y = coord
+        return 0 <= x <= self.MAX_X and 0 <= y <= self.MAX_Y \
+            and self.grid.cells[y * self.grid.width + x] in pathfinding.PASSABLE
 
 
     def filter_tile_neighbors_metalbox (self, coord):
         """ 
         Checks if selected tile is either grass, wooden box or metal box. 
         """
-        if coord[0] <= self.MAX_X \
-            and coord[1] <= self.MAX_Y \
-            and coord[0] >= 0 \
-            and coord[1] >= 0 \
-            and (self.filter_tile_neighbors(coord) \
-            or self.currentmap.boxAt(coord[0], coord[1]) == 3):
-        
-            return True
-        else:
-            return False
-            
\ No newline at end of file
+        x, y = coord
+        return 0 <= x <= self.MAX_X and 0 <= y <= self.MAX_Y \
+            and self.grid.cells[y * self.grid.width + x] \
+                in pathfinding.PASSABLE_METAL
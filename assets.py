@@ -0,0 +1,26 @@
+import pygame
+
+TILE_SIZE = 40  # Define the default size of tiles
+
+# Change this to run the game without loading any images or sounds,
+# for instance on a server without a display or an audio device.
+HEADLESS = False
+
+
+def sprite(name):
+    """
+    Returns the image called name from the images module, or None if the
+    game is headless. The images are loaded the first time this is called.
+    """
+    if HEADLESS:
+        return None
+    import images
+    return getattr(images, name)
+
+
+def play_sound(name):
+    """ Plays the sound called name from the sounds module, unless headless. """
+    if HEADLESS:
+        return
+    import sounds
+    pygame.mixer.Sound.play(getattr(sounds, name))
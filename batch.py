@@ -0,0 +1,124 @@
+"""
+Runs matches between ai tanks without a window, spread over several
+processes, and writes the results of every match to a JSONL or CSV file.
+Run from the repository root, for example:
+
+    python batch.py --seeds 10 --ticks 5000
+    python batch.py --maps "Map 2.txt" --rounds 3 --output results.csv
+"""
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import engine
+import maps
+
+# Columns of the results, in the order they are written to a CSV file
+FIELDS = ["map", "seed", "ticks", "rounds", "wall_time", "scores",
+          "captures", "kills"]
+
+
+def run_match(map_name, seed, max_ticks, max_rounds, ai_budget_ms,
+              deterministic):
+    """
+    Plays one match on the map until max_ticks ticks have passed or
+    max_rounds rounds have been won (0 for no limit), and returns its
+    results as a dict with the keys in FIELDS.
+    """
+    world = engine.World(maps.load_map(map_name), 0, headless = True,
+                         ai_budget_ms = ai_budget_ms, seed = seed,
+                         deterministic = deterministic)
+    start = time.perf_counter()
+    while world.ticks < max_ticks:
+        world.tick()
+        if max_rounds > 0 and world.rounds >= max_rounds:
+            break
+    wall_time = time.perf_counter() - start
+    world.close()
+
+    return {
+        "map":       map_name,
+        "seed":      seed,
+        "ticks":     world.ticks,
+        "rounds":    world.rounds,
+        "wall_time": round(wall_time, 4),
+        "scores":    [tank.score for tank in world.tanks_list],
+        "captures":  [tank.captures for tank in world.tanks_list],
+        "kills":     [tank.kills for tank in world.tanks_list],
+    }
+
+
+def all_maps():
+    """ Returns the file names of all the maps in the maps directory. """
+    return sorted(os.listdir(os.path.join(maps.main_dir, "maps")))
+
+
+def open_writer(file_name):
+    """
+    Opens file_name for writing and returns the file and a function that
+    writes one result to it, as CSV if the name ends with .csv and as
+    JSON lines otherwise.
+    """
+    file = open(file_name, "w", newline = "")
+    if file_name.endswith(".csv"):
+        writer = csv.DictWriter(file, FIELDS)
+        writer.writeheader()
+
+        def write(result):
+            row = dict(result)
+            for key in ("scores", "captures", "kills"):
+                row[key] = " ".join(str(value) for value in row[key])
+            writer.writerow(row)
+    else:
+        def write(result):
+            file.write(json.dumps(result) + "\n")
+    return file, write
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--maps", nargs="+", default=all_maps(),
+                        help="file names of the maps, all of them by default")
+    parser.add_argument("--seeds", type=int, default=4,
+                        help="number of matches per map")
+    parser.add_argument("--ticks", type=int, default=5000,
+                        help="maximum number of ticks of a match")
+    parser.add_argument("--rounds", type=int, default=0,
+                        help="stop a match after this many rounds, 0 for no limit")
+    parser.add_argument("--ai-budget-ms", type=float, default=4)
+    parser.add_argument("--deterministic", action="store_true",
+                        help="no ai time budget, the results are reproducible")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output", default="results.jsonl",
+                        help="results file, CSV if it ends with .csv")
+    args = parser.parse_args()
+
+    jobs = [(map_name, seed, args.ticks, args.rounds, args.ai_budget_ms,
+             args.deterministic)
+            for map_name in args.maps for seed in range(args.seeds)]
+    file, write = open_writer(args.output)
+    total_ticks = 0
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.workers) as executor:
+        futures = [executor.submit(run_match, *job) for job in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            write(result)
+            total_ticks += result["ticks"]
+            print("%-12s seed %3d: %6d ticks, %2d rounds, scores %s" % (
+                result["map"], result["seed"], result["ticks"],
+                result["rounds"], result["scores"]))
+    elapsed = time.perf_counter() - start
+    file.close()
+
+    print("%d matches on %d workers in %.1f s: %.2f matches/s, %.0f ticks/s"
+          % (len(jobs), args.workers, elapsed, len(jobs) / elapsed,
+             total_ticks / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,685 @@
+"""
+Micro-benchmarks for the game. Run from the repository root, for example:
+
+    python benchmark.py pathfinding --sizes 50 100 200
+    python benchmark.py flowfield --tanks 1 10 50
+    python benchmark.py incremental --size 100 --steps 200
+    python benchmark.py astar --sizes 50 100 200
+    python benchmark.py ticks --save before.json
+    python benchmark.py ticks --compare before.json --threshold 0.3
+    python benchmark.py walls --sizes 100 200 300
+    python benchmark.py render --size 50 --frames 300
+    python benchmark.py draw --size 60 --density 0.5
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+from collections import deque
+
+# -- Run without a window or an audio device
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+# -- The images are loaded relative to the repository root
+os.chdir(os.path.split(os.path.abspath(__file__))[0])
+
+import pygame
+import pymunk
+from pymunk import Vec2d
+
+import ai
+import engine
+import entities
+import gameobjects
+import images
+import maps
+import movement
+import occupancy
+import pathfinding
+import renderer
+
+
+def generate_map(size, density, seed, box_types = (1, 2, 3)):
+    """
+    Generates a square map of the given size where roughly density of the
+    tiles are boxes, picked from box_types. The start position is in the
+    upper left corner and the flag in the lower right corner, both are
+    kept free.
+    """
+    rng = random.Random(seed)
+    boxes = [
+        [rng.choice(box_types) if rng.random() < density else 0
+         for x in range(size)]
+        for y in range(size)
+    ]
+    boxes[0][0] = 0
+    boxes[size - 1][size - 1] = 0
+    return maps.Map(
+        "Synthetic %d" % size, size, size, boxes,
+        [[0.5, 0.5, 0]], [size - 0.5, size - 0.5]
+    )
+
+
+def create_ai(current_map, pos = None, distance_fields = None, grid = None,
+              planner = None):
+    """
+    Creates an Ai for a tank at pos, which defaults to the first start
+    position of the map.
+    """
+    space = pymunk.Space()
+    if pos == None:
+        pos = current_map.start_positions[0]
+    tank = gameobjects.Tank(pos[0], pos[1], pos[2], images.tanks[0], space)
+    flag = gameobjects.Flag(
+        current_map.flag_position[0], current_map.flag_position[1]
+    )
+    registry = entities.EntityRegistry()
+    registry.add(tank)
+    registry.add(flag)
+    return ai.Ai(
+        tank, registry, [tank], space, current_map, distance_fields,
+        planner, grid
+    )
+
+
+def free_positions(current_map, count, seed):
+    """ Returns count random start positions on grass tiles. """
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        x = rng.randrange(current_map.width)
+        y = rng.randrange(current_map.height)
+        if current_map.boxAt(x, y) == 0:
+            positions.append([x + 0.5, y + 0.5, 0])
+    return positions
+
+
+def copying_bfs(ai_tank, allow_metal = False):
+    """
+    The previous implementation of Ai.find_shortest_path, which copies the
+    whole path for every visited node. Kept as a reference point.
+    """
+    start_node = (ai_tank.grid_pos[0], ai_tank.grid_pos[1])
+    queue = deque([start_node])
+    visited = set()
+    paths = {start_node: [Vec2d(start_node[0], start_node[1])]}
+    while queue:
+        node = queue.popleft()
+        if node == ai_tank.get_target_tile():
+            result = deque(paths[node])
+            result.popleft()
+            return result
+        for neighbour in ai_tank.get_tile_neighbors(node, allow_metal):
+            if (neighbour[0], neighbour[1]) not in visited:
+                neighbour = (neighbour[0], neighbour[1])
+                queue.append(neighbour)
+                visited.add(neighbour)
+                paths[neighbour] = paths[node].copy()
+                paths[neighbour].append(Vec2d(neighbour[0], neighbour[1]))
+    return deque([])
+
+
+def time_calls(function, repeat):
+    """ Returns the best time in seconds of calling function repeat times. """
+    best = float("inf")
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_pathfinding(args):
+    """ Compares the copying BFS with the parent-pointer BFS. """
+    print("%8s %12s %12s %8s %8s" % ("size", "copying ms", "parents ms",
+                                      "speedup", "length"))
+    for size in args.sizes:
+        ai_tank = create_ai(generate_map(size, args.density, args.seed))
+        path = ai_tank.find_shortest_path(True)
+        assert len(path) == len(copying_bfs(ai_tank, True))
+
+        old = time_calls(lambda: copying_bfs(ai_tank, True), args.repeat)
+        new = time_calls(lambda: ai_tank.find_shortest_path(True), args.repeat)
+        print("%8d %12.2f %12.2f %7.1fx %8d" % (
+            size, old * 1000, new * 1000, old / new, len(path)))
+
+
+def bench_flowfield(args):
+    """
+    Compares one search per ai tank with a distance field shared by all the
+    tanks, for a growing number of tanks heading for the same flag.
+    """
+    current_map = generate_map(args.size, args.density, args.seed)
+    grid = occupancy.OccupancyGrid(current_map)
+    print("%8s %12s %12s %8s %8s" % ("tanks", "searches ms", "field ms",
+                                      "speedup", "reached"))
+    for count in args.tanks:
+        positions = free_positions(current_map, count, args.seed)
+        searching = [create_ai(current_map, pos, grid = grid)
+                     for pos in positions]
+        sharing = [create_ai(current_map, pos, grid = grid)
+                   for pos in positions]
+
+        # The searches are run to the end, the paths the ai keeps between
+        # ticks are not used, and every repetition starts without fields
+        def plan_with_fields():
+            distance_fields = pathfinding.DistanceFields(grid)
+            for ai_tank in sharing:
+                ai_tank.distance_fields = distance_fields
+                ai_tank.find_shortest_path(True)
+
+        paths = [ai_tank.find_shortest_path(True) for ai_tank in searching]
+        plan_with_fields()
+        assert [len(path) for path in paths] \
+            == [len(ai_tank.find_shortest_path(True)) for ai_tank in sharing]
+
+        old = time_calls(
+            lambda: [ai_tank.find_shortest_path(True)
+                     for ai_tank in searching],
+            args.repeat
+        )
+        new = time_calls(plan_with_fields, args.repeat)
+        print("%8d %12.2f %12.2f %7.1fx %8d" % (
+            count, old * 1000, new * 1000, old / new,
+            len([path for path in paths if path])))
+
+
+def bench_incremental(args):
+    """
+    Drives a tank along its path on a map full of destructible boxes while
+    wooden boxes are destroyed and metal boxes are pushed, and replans after
+    every step with the breadth first search and with the D* Lite planner.
+    """
+    current_map = generate_map(
+        args.size, args.density, args.seed, (1, 2, 2, 2, 3)
+    )
+    grid = occupancy.OccupancyGrid(current_map)
+    ai_tank = create_ai(current_map, grid = grid)
+    planner = pathfinding.IncrementalPlanner(grid)
+    target = ai_tank.get_target_tile()
+    rng = random.Random(args.seed)
+    bfs_time = incremental_time = 0
+    replans = 0
+
+    for step in range(args.steps):
+        for i in range(args.changes):
+            x = rng.randrange(current_map.width)
+            y = rng.randrange(current_map.height)
+            box_type = grid.boxAt(x, y)
+            if box_type == 2:
+                # Destroy a wooden box
+                grid.set_box(x, y, 0)
+            elif box_type == 3:
+                # Push a metal box onto a free neighbour
+                nx, ny = x + rng.choice((-1, 1)), y
+                if 0 <= nx < grid.width and grid.boxAt(nx, ny) == 0 \
+                    and (nx, ny) != tuple(ai_tank.grid_pos):
+                    grid.move_box((x, y), (nx, ny), 3)
+
+        start = time.perf_counter()
+        path = ai_tank.find_shortest_path()
+        bfs_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        repaired = planner.find_shortest_path(ai_tank.grid_pos, target)
+        incremental_time += time.perf_counter() - start
+
+        assert len(path) == len(repaired)
+        replans += 1
+        if not path:
+            break
+        ai_tank.grid_pos = path[0]
+
+    print("%d replans, %d tiles expanded by D* Lite" % (
+        replans, planner.expansions))
+    print("%12s %12s %8s" % ("bfs/s", "d* lite/s", "speedup"))
+    print("%12.1f %12.1f %7.1fx" % (
+        replans / bfs_time, replans / incremental_time,
+        bfs_time / incremental_time))
+
+
+def two_pass_search(ai_tank):
+    """ The breadth first search, retried with metal boxes if it fails. """
+    return ai_tank.find_shortest_path() or ai_tank.find_shortest_path(True)
+
+
+def bench_astar(args):
+    """
+    Compares the two breadth first searches with a single weighted A*
+    search, on maps where metal boxes block most of the ways to the flag.
+    """
+    print("%8s %12s %12s %8s %12s" % ("size", "two-pass ms", "a* ms",
+                                      "speedup", "a* expanded"))
+    for size in args.sizes:
+        current_map = generate_map(
+            size, args.density, args.seed, (1, 2, 3, 3, 3)
+        )
+        grid = occupancy.OccupancyGrid(current_map)
+        planner = pathfinding.AStarPlanner(grid)
+        positions = free_positions(current_map, args.searches, args.seed)
+        searching = [create_ai(current_map, pos, grid = grid)
+                     for pos in positions]
+        weighted = [create_ai(current_map, pos, grid = grid,
+                              planner = planner) for pos in positions]
+
+        old = time_calls(
+            lambda: [two_pass_search(ai_tank) for ai_tank in searching],
+            args.repeat
+        )
+        planner.expansions = 0
+        new = time_calls(
+            lambda: [ai_tank.find_shortest_path() for ai_tank in weighted],
+            args.repeat
+        )
+        print("%8d %12.2f %12.2f %7.1fx %12d" % (
+            size, old * 1000, new * 1000, old / new,
+            planner.expansions // args.repeat))
+
+
+# -- The phases of World.tick, as named by World.profiler
+TICK_PHASES = ["update", "step", "count", "post_update", "aim", "decide",
+               "flag"]
+
+# -- The maps and the synthetic arenas (size, tanks) of the ticks benchmark
+TICK_SCENARIOS = [
+    "Map 1", "Map 2", "Map 3",
+    "100x100/6", "100x100/25", "100x100/100",
+    "300x300/6", "300x300/100",
+]
+
+
+def generate_arena(size, density, tanks, seed):
+    """
+    Generates a map like generate_map with the flag in the middle and the
+    given number of tanks starting on random grass tiles.
+    """
+    current_map = generate_map(size, density, seed)
+    centre = size // 2
+    current_map.boxes[centre][centre] = 0
+    current_map.flag_position = [centre + 0.5, centre + 0.5]
+
+    rng = random.Random(seed)
+    free = [(x, y) for y in range(size) for x in range(size)
+            if current_map.boxAt(x, y) == 0 and (x, y) != (centre, centre)]
+    current_map.start_positions = [
+        [x + 0.5, y + 0.5, 0] for x, y in rng.sample(free, tanks)
+    ]
+    return current_map
+
+
+def generate_walled_arena(size, spacing, density, tanks, seed):
+    """
+    Generates an arena like generate_arena, crossed by rock walls along
+    every spacing-th row and column. Every wall has a gap between two
+    crossings, and the start positions and the flag are kept free.
+    """
+    current_map = generate_arena(size, density, tanks, seed)
+    rng = random.Random(seed)
+    boxes = current_map.boxes
+    for line in range(spacing, size - 1, spacing):
+        for start in range(0, size, spacing):
+            gap = start + rng.randrange(1, spacing)
+            for i in range(start, min(start + spacing, size)):
+                if i != gap:
+                    boxes[line][i] = 1
+                    boxes[i][line] = 1
+    for x, y, angle in current_map.start_positions:
+        boxes[int(y)][int(x)] = 0
+    x, y = current_map.flag_position
+    boxes[int(y)][int(x)] = 0
+    return current_map
+
+
+def scenario_map(name, density, seed):
+    """ Returns the map of a scenario, such as "Map 2" or "100x100/25". """
+    if "/" not in name:
+        return maps.load_map(name + ".txt")
+    size, tanks = name.split("/")
+    return generate_arena(int(size.split("x")[0]), density, int(tanks), seed)
+
+
+def run_ticks(name, ticks, density, seed, batch = True, sleep = True):
+    """
+    Runs a headless match with no ai time budget for the given number of
+    ticks, in a process of its own so that the peak memory is its own, and
+    returns its statistics. The times of the phases are in ms per tick, and the
+    numbers of awake and sleeping bodies are means per tick. Without
+    batch the tanks and boxes update one by one, without sleep no body
+    ever falls asleep.
+    """
+    movement.available = movement.available and batch
+    # Not deterministic, which would turn sleeping off, but with the same
+    # ai work on every run
+    world = engine.World(scenario_map(name, density, seed), 0,
+                         headless = True, seed = seed, ai_budget_ms = None,
+                         sleep_time = engine.SLEEP_TIME if sleep else None)
+    profiler = world.profiler
+    profiler.enabled = True
+    tick_times = []
+
+    for i in range(ticks):
+        start = time.perf_counter()
+        profiler.start_tick()
+        world.tick()
+        profiler.end_tick()
+        tick_times.append(time.perf_counter() - start)
+    world.close()
+
+    tick_times.sort()
+    return name, {
+        "tanks": len(world.tanks_list),
+        "objects": len(world.entities),
+        "ticks_per_s": ticks / sum(tick_times),
+        "p50_ms": tick_times[len(tick_times) // 2] * 1000,
+        "p99_ms": tick_times[int(len(tick_times) * 0.99)] * 1000,
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        "peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            / (2**20 if sys.platform == "darwin" else 2**10),
+        "phases_ms": {phase: profiler.totals.get(phase, 0) / ticks
+                      for phase in TICK_PHASES},
+        "awake": profiler.totals.get("awake", 0) / ticks,
+        "sleeping": profiler.totals.get("sleeping", 0) / ticks,
+    }
+
+
+def bench_walls(args):
+    """
+    Compares a shape per rock box with the rock boxes merged into a few
+    rectangles, on large arenas crossed by rock walls: the number of
+    shapes in the space and the time of space.step. The world is
+    headless, so its step phase is space.step alone.
+    """
+    print("%8s %8s %14s %14s %14s %14s %8s" % (
+        "size", "rocks", "shapes/box", "shapes/merged", "step ms/box",
+        "step ms/merged", "speedup"))
+    for size in args.sizes:
+        current_map = generate_walled_arena(size, args.spacing, args.density,
+                                            args.tanks, args.seed)
+        rocks = sum(row.count(1) for row in current_map.boxes)
+        shapes = []
+        step_ms = []
+        for merge_rocks in (False, True):
+            world = engine.World(current_map, 0, headless = True,
+                                 seed = args.seed, ai_budget_ms = None,
+                                 merge_rocks = merge_rocks)
+            world.profiler.enabled = True
+            for i in range(args.ticks):
+                world.profiler.start_tick()
+                world.tick()
+                world.profiler.end_tick()
+            shapes.append(len(world.space.shapes))
+            step_ms.append(world.profiler.totals["step"] / args.ticks)
+            world.close()
+        print("%8d %8d %14d %14d %14.3f %14.3f %7.1fx" % (
+            size, rocks, shapes[0], shapes[1], step_ms[0], step_ms[1],
+            step_ms[0] / step_ms[1]))
+
+
+class NoRotationCache:
+    """ Rotates the sprites every time, as before there was a cache. """
+
+    def rotate(self, sprite, angle):
+        return pygame.transform.rotate(sprite, angle)
+
+
+def bench_render(args):
+    """
+    Compares the time to draw the game objects of an arena when every
+    sprite is rotated on every frame and with the rotation cache. Both
+    draw the same frames, one tick apart.
+    """
+    current_map = generate_arena(args.size, args.density, args.tanks,
+                                 args.seed)
+    world = engine.World(current_map, 0, seed = args.seed,
+                         deterministic = True)
+    screen = pygame.Surface(current_map.rect().size)
+    cache = gameobjects.RotationCache(args.step, args.max_size)
+    times = {"rotate": 0, "cache": 0}
+
+    for frame in range(args.frames):
+        world.tick()
+        for name, rotation in (("rotate", NoRotationCache()),
+                               ("cache", cache)):
+            gameobjects.rotation_cache = rotation
+            start = time.perf_counter()
+            for obj in world.entities:
+                obj.update_screen(screen, world.alpha)
+            times[name] += time.perf_counter() - start
+    world.close()
+
+    old = times["rotate"] / args.frames * 1000
+    new = times["cache"] / args.frames * 1000
+    print("%d objects, %d frames" % (len(world.entities), args.frames))
+    print("%12s %12s %8s %8s %8s %8s" % ("rotate ms", "cache ms", "speedup",
+                                         "hits", "misses", "cached"))
+    print("%12.3f %12.3f %7.1fx %8d %8d %8d" % (
+        old, new, old / new, cache.hits, cache.misses, len(cache.sprites)))
+
+
+def bench_draw(args):
+    """
+    Compares three ways of drawing the frames of an arena with a thousand
+    or more sprites: update_screen() on every object, the renderer with
+    one Surface.blits call per frame, and the renderer with dirty
+    rectangles. All of them draw the same frames, between two ticks.
+    """
+    current_map = generate_arena(args.size, args.density, args.tanks,
+                                 args.seed)
+    world = engine.World(current_map, 0, seed = args.seed,
+                         deterministic = True)
+    screen = pygame.display.set_mode(current_map.rect().size)
+    renderers = {
+        "objects": renderer.Renderer(world, images.grass),
+        "blits": renderer.Renderer(world, images.grass),
+        "dirty": renderer.Renderer(world, images.grass, dirty_rects = True),
+    }
+    screens = {name: screen.copy() for name in renderers}
+    renderers["objects"].build_layer(screen.get_size())
+    times = dict.fromkeys(renderers, 0)
+    rng = random.Random(args.seed)
+
+    for frame in range(args.frames):
+        world.tick()
+        alpha = rng.random()
+        for name, world_renderer in renderers.items():
+            start = time.perf_counter()
+            if name == "objects":
+                screens[name].blit(world_renderer.layer, (0, 0))
+                for obj in sorted(world.entities.actors.values(),
+                                  key=lambda obj: obj.layer):
+                    obj.update_screen(screens[name], alpha)
+            else:
+                world_renderer.draw(screens[name], alpha)
+            times[name] += time.perf_counter() - start
+    world.close()
+
+    print("%d sprites per frame, %d frames" % (
+        len(world.entities.actors), args.frames))
+    print("%10s %10s %8s" % ("", "ms/frame", "speedup"))
+    for name, total in times.items():
+        print("%10s %10.3f %7.1fx" % (name, total / args.frames * 1000,
+                                      times["objects"] / total))
+
+
+def compare_ticks(results, baseline, threshold):
+    """
+    Prints the change of every scenario against the baseline, flags the
+    ones whose ticks/s dropped by more than threshold, as a fraction, and
+    returns how many there are. The p99 is shown but too noisy to flag.
+    """
+    regressions = 0
+    for name, result in results.items():
+        before = baseline["scenarios"].get(name)
+        if before == None:
+            continue
+        change = result["ticks_per_s"] / before["ticks_per_s"] - 1
+        p99_change = result["p99_ms"] / before["p99_ms"] - 1
+        flag = ""
+        if change < -threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print("%-12s ticks/s %+6.1f%%, p99 %+6.1f%%%s" % (
+            name, change * 100, p99_change * 100, flag))
+    return regressions
+
+
+def bench_ticks(args):
+    """
+    Measures the tick throughput of headless matches on the bundled maps
+    and on large synthetic arenas, phase by phase. Every scenario is run
+    repeat times, the repetitions taking turns, and the fastest run is
+    kept. The results can be saved as JSON and compared with an earlier
+    run.
+    """
+    phases = TICK_PHASES
+    print(("%-12s %6s %9s %8s %8s %8s" + " %11s" * len(phases) + " %7s %8s")
+          % (("scenario", "tanks", "ticks/s", "p50 ms", "p99 ms", "peak MB")
+             + tuple(phase + " ms" for phase in phases)
+             + ("awake", "sleeping")))
+
+    results = {}
+    jobs = [(name, args.ticks, args.density, args.seed, not args.no_batch,
+             not args.no_sleep)
+            for name in args.scenarios]
+    # The repetitions take turns, so that a slow spell of the computer
+    # does not fall on all the runs of one scenario
+    runs = {}
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        for name, result in pool.starmap(run_ticks, jobs * args.repeat,
+                                         chunksize=1):
+            runs.setdefault(name, []).append(result)
+
+    for name, scenario_runs in runs.items():
+        scenario_runs.sort(key=lambda result: result["ticks_per_s"])
+        result = results[name] = scenario_runs[-1]
+        result["runs_ticks_per_s"] = [run["ticks_per_s"]
+                                      for run in scenario_runs]
+        print(("%-12s %6d %9.0f %8.2f %8.2f %8.1f" + " %11.3f" * len(phases)
+               + " %7.0f %8.0f")
+              % ((name, result["tanks"], result["ticks_per_s"],
+                  result["p50_ms"], result["p99_ms"], result["peak_mb"])
+                 + tuple(result["phases_ms"][phase] for phase in phases)
+                 + (result["awake"], result["sleeping"])))
+
+    if args.save != None:
+        file = open(args.save, "w")
+        json.dump({"ticks": args.ticks, "seed": args.seed,
+                   "scenarios": results}, file, indent=2)
+        file.close()
+
+    if args.compare != None:
+        file = open(args.compare)
+        baseline = json.load(file)
+        file.close()
+        if baseline["ticks"] != args.ticks:
+            print("The baseline ran %d ticks per scenario, not %d" % (
+                baseline["ticks"], args.ticks))
+        if compare_ticks(results, baseline, args.threshold) > 0:
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    sub = subparsers.add_parser(
+        "pathfinding", help="shortest path search on large synthetic maps"
+    )
+    sub.add_argument("--sizes", type=int, nargs="+", default=[50, 100, 200])
+    sub.add_argument("--density", type=float, default=0.2)
+    sub.set_defaults(run=bench_pathfinding)
+
+    sub = subparsers.add_parser(
+        "flowfield", help="one search per tank against a shared field"
+    )
+    sub.add_argument("--tanks", type=int, nargs="+", default=[1, 5, 20, 50])
+    sub.add_argument("--size", type=int, default=100)
+    sub.add_argument("--density", type=float, default=0.2)
+    sub.set_defaults(run=bench_flowfield)
+
+    sub = subparsers.add_parser(
+        "incremental", help="replanning with D* Lite while boxes change"
+    )
+    sub.add_argument("--size", type=int, default=100)
+    sub.add_argument("--density", type=float, default=0.4)
+    sub.add_argument("--steps", type=int, default=200)
+    sub.add_argument("--changes", type=int, default=5,
+                     help="boxes destroyed or pushed before each replan")
+    sub.set_defaults(run=bench_incremental)
+
+    sub = subparsers.add_parser(
+        "astar", help="weighted A* against the two-pass breadth first search"
+    )
+    sub.add_argument("--sizes", type=int, nargs="+", default=[50, 100, 200])
+    sub.add_argument("--density", type=float, default=0.45)
+    sub.add_argument("--searches", type=int, default=10,
+                     help="searches from random start positions per map")
+    sub.set_defaults(run=bench_astar)
+
+    sub = subparsers.add_parser(
+        "ticks", help="tick throughput of headless matches, phase by phase"
+    )
+    sub.add_argument("--scenarios", nargs="+", default=TICK_SCENARIOS,
+                     help="map names, or arenas as SIZExSIZE/TANKS")
+    sub.add_argument("--ticks", type=int, default=500)
+    sub.add_argument("--density", type=float, default=0.1)
+    sub.add_argument("--no-batch", action="store_true",
+                     help="update the tanks and boxes one by one")
+    sub.add_argument("--no-sleep", action="store_true",
+                     help="no body ever falls asleep")
+    sub.add_argument("--save", help="write the results to this JSON file")
+    sub.add_argument("--compare", help="JSON file of an earlier run")
+    # The best of 3 runs still varies by up to 27% from one run of the
+    # benchmark to the next on a busy computer
+    sub.add_argument("--threshold", type=float, default=0.3,
+                     help="slowdown, as a fraction, reported as a regression")
+    sub.set_defaults(run=bench_ticks)
+
+    sub = subparsers.add_parser(
+        "walls", help="physics shapes per rock box against merged rock walls"
+    )
+    sub.add_argument("--sizes", type=int, nargs="+", default=[100, 200, 300])
+    sub.add_argument("--spacing", type=int, default=8,
+                     help="tiles between two rock walls")
+    sub.add_argument("--density", type=float, default=0.05)
+    sub.add_argument("--tanks", type=int, default=6)
+    sub.add_argument("--ticks", type=int, default=200)
+    sub.set_defaults(run=bench_walls)
+
+    sub = subparsers.add_parser(
+        "render", help="drawing the game objects with the rotation cache"
+    )
+    sub.add_argument("--size", type=int, default=50)
+    sub.add_argument("--density", type=float, default=0.3)
+    sub.add_argument("--tanks", type=int, default=6,
+                     help="at most 6, the number of tank sprites")
+    sub.add_argument("--frames", type=int, default=300)
+    sub.add_argument("--step", type=float, default=gameobjects.ROTATION_STEP,
+                     help="angles are rounded to this many degrees")
+    sub.add_argument("--max-size", type=int,
+                     default=gameobjects.MAX_ROTATED_SPRITES)
+    sub.set_defaults(run=bench_render)
+
+    sub = subparsers.add_parser(
+        "draw", help="drawing thousands of sprites with Surface.blits"
+    )
+    sub.add_argument("--size", type=int, default=60)
+    sub.add_argument("--density", type=float, default=0.5)
+    sub.add_argument("--tanks", type=int, default=6,
+                     help="at most 6, the number of tank sprites")
+    sub.add_argument("--frames", type=int, default=200)
+    sub.set_defaults(run=bench_draw)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-import images
+import assets
 
 class BoxModel:
   """ 
@@ -7,17 +7,24 @@ class BoxModel:
   whether it can be moved, destroyed and the sprite.
   """
 
-  def __init__(self, sprite, movable, destructable):
-    self.sprite         = sprite
+  def __init__(self, type, sprite_name, movable, destructable):
+    self.type           = type
+    self.sprite_name    = sprite_name
     self.movable        = movable
     self.destructable   = destructable
 
 
-woodbox  = BoxModel(images.woodbox,  movable=True, destructable=True)
+  @property
+  def sprite(self):
+    """ The image of the box, loaded when it is first needed. """
+    return assets.sprite(self.sprite_name)
 
-metalbox = BoxModel(images.metalbox, movable=True, destructable=False)
 
-rockbox  = BoxModel(images.rockbox, movable=False, destructable=False)
+woodbox  = BoxModel(2, "woodbox",  movable=True, destructable=True)
+
+metalbox = BoxModel(3, "metalbox", movable=True, destructable=False)
+
+rockbox  = BoxModel(1, "rockbox", movable=False, destructable=False)
 
 
 def get_model(type):
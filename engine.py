@@ -0,0 +1,572 @@
+import ai
+import assets
+import boxmodels
+import entities
+import gameobjects
+import movement
+import occupancy
+import pathfinding
+import profiler
+import pymunk
+import random
+import struct
+import zlib
+
+# Number of physics ticks per second of game time. The timers of the game,
+# such as the cooldown of the tanks, count physics ticks.
+PHYSICS_RATE = 50
+# Number of times per second the objects update their speed
+CONTROL_RATE = PHYSICS_RATE / 3
+# Number of times per second the ai tanks decide
+AI_RATE = PHYSICS_RATE
+# At most this many ticks are run by World.advance, if the computer can't
+# keep up the game slows down instead of freezing
+MAX_TICKS_PER_ADVANCE = 5
+# A body slower than IDLE_SPEED, in tiles per second, for SLEEP_TIME seconds
+# of game time falls asleep, and is skipped by the physics until something
+# touches it
+SLEEP_TIME = 0.5
+IDLE_SPEED = 0.05
+# When profiling, the awake and sleeping bodies are counted every this many
+# ticks, counting them takes longer than the physics step on large maps
+BODY_COUNT_INTERVAL = 10
+
+
+class World:
+    """
+    The simulation of one game of capture the flag on a map. It builds the
+    physics, the game objects and the ai tanks, and advances them one tick
+    at a time with tick(). It neither draws nor waits, so it can run
+    without a display at any speed.
+    """
+
+    def __init__(self, current_map, players = 1, headless = False,
+                 ai_budget_ms = 4, planner_processes = 0, seed = None,
+                 deterministic = False, physics_rate = PHYSICS_RATE,
+                 control_rate = CONTROL_RATE, ai_rate = AI_RATE,
+                 sleep_time = SLEEP_TIME, idle_speed = IDLE_SPEED,
+                 merge_rocks = True):
+        """
+        Takes the map to play on and the number of tanks, starting with
+        the first one, that are controlled by players. The other tanks get
+        an ai. If headless, no images or sounds are loaded (see assets)
+        until close() is called.
+        ai_budget_ms is the time per tick for the ai, and path planning is
+        done by that many worker processes if planner_processes > 0.
+        The ai tanks break ties between paths of the same length with
+        self.random, seeded with seed or with a random seed.
+        If deterministic, a match only depends on the map, the seed and
+        the controls of the player tanks on every tick. This fixes three
+        things: the ai has no time budget, so it decides the same whatever
+        the speed of the computer, it plans in this process, so no path
+        arrives late, and no body falls asleep, since Chipmunk wakes
+        bodies up in an order that depends on where they are in memory.
+        The seed is not fixed, self.seed is the one to give to play the
+        same match again.
+        The rates are in times per second of game time, the control and
+        ai rates should not be above the physics rate.
+        Bodies slower than idle_speed for sleep_time seconds fall asleep,
+        no body ever does if sleep_time is None or if deterministic.
+        If merge_rocks, the rock boxes are merged into one gameobjects.Wall
+        instead of being a box each.
+        """
+        # -- assets.HEADLESS is set back to this by close()
+        self.was_headless = assets.HEADLESS
+        if headless:
+            assets.HEADLESS = True
+        # Nothing is drawn without a display, so nothing is interpolated
+        self.interpolate = not headless
+        if deterministic:
+            ai_budget_ms = None
+            planner_processes = 0
+            sleep_time = None
+
+        self.current_map = current_map
+        self.merge_rocks = merge_rocks
+        self.sleep_time = sleep_time
+        self.idle_speed = idle_speed
+        self.ticks = 0
+        self.rounds = 0
+        self.physics_rate = physics_rate
+        # -- Ticks a tank waits after a shot, one second of game time
+        self.shot_cooldown = round(physics_rate)
+        self.control_rate = control_rate
+        self.ai_rate = ai_rate
+        # -- Game time owed to the control updates, the ai and World.advance,
+        #    the first tick runs both
+        self.control_time = physics_rate - control_rate
+        self.ai_time = physics_rate - ai_rate
+        self.accumulator = 0
+        self.alpha = 1.0
+        if seed == None:
+            seed = random.randrange(2**63)
+        self.seed = seed
+        self.random = random.Random(seed)
+
+        # -- Set to an InputRecorder (see replay) to record the controls
+        self.recorder = None
+
+        # -- Initialise the physics engine
+        self.space = pymunk.Space()
+        self.space.gravity = (0.0, 0.0)
+        if sleep_time != None:
+            self.space.sleep_time_threshold = sleep_time
+            self.space.idle_speed_threshold = idle_speed
+
+        # -- Batch update of the speed of the tanks and boxes, if NumPy is
+        #    installed, otherwise they update one by one
+        self.movement = None
+        batched = post_batched = ()
+        if movement.available:
+            self.movement = movement.MovementStore(self.space)
+            batched = (gameobjects.Tank, gameobjects.Box)
+            post_batched = (gameobjects.Box,)
+
+        # -- All the game objects
+        self.entities = entities.EntityRegistry(batched, post_batched)
+        self.tanks_list = []
+        self.ai_list = ai.AiRegistry()
+
+        # -- Box types of the tiles, kept up to date while boxes move or break
+        self.grid = occupancy.OccupancyGrid(current_map)
+
+        # -- Distance fields shared by all the ai tanks
+        self.distance_fields = pathfinding.DistanceFields(self.grid)
+
+        # -- Worker processes for the ai path planning, if enabled
+        self.planner_pool = None
+        if planner_processes > 0:
+            self.planner_pool = pathfinding.PlannerPool(
+                self.grid, planner_processes
+            )
+
+        # -- Line of sight checks shared by all the ai tanks
+        self.targeting = ai.Targeting(self.space, current_map,
+                                    entities = self.entities)
+
+        # -- Times the phases of the ticks when enabled
+        self.profiler = profiler.TickProfiler()
+        # Numbers of awake and sleeping bodies, see count_bodies()
+        self.body_counts = None
+
+        # -- Spreads the ai path planning over several ticks if it takes too long
+        self.ai_scheduler = ai.AiScheduler(ai_budget_ms, self.profiler)
+
+        self.create_walls()
+        self.create_boxes()
+        self.create_tanks(players)
+
+        # -- Create the flag
+        self.flag = gameobjects.Flag(
+            current_map.flag_position[0], current_map.flag_position[1])
+        self.entities.add(self.flag)
+
+        self.add_collision_handlers()
+
+
+    def create_walls(self):
+        """ Generate walls around the map, and the merged rock boxes. """
+        width, height = self.current_map.width, self.current_map.height
+        border_body = pymunk.Body(body_type=pymunk.Body.STATIC)
+        border_lines = [
+            pymunk.Segment(border_body, (0, 0), (width, 0), 0),
+            pymunk.Segment(border_body, (0, 0), (0, height), 0),
+            pymunk.Segment(border_body, (0, height), (width, height), 0),
+            pymunk.Segment(border_body, (width, height), (width, 0), 0)
+        ]
+
+        # Add each segment individually to the space
+        self.space.add(border_body)
+        for line in border_lines:
+            self.space.add(line)
+
+        # The rock boxes
+        if self.merge_rocks:
+            rectangles = self.current_map.rectangles(boxmodels.rockbox.type)
+            if rectangles:
+                self.entities.add(gameobjects.Wall(
+                    rectangles, boxmodels.rockbox, self.space))
+
+
+    def create_boxes(self):
+        """
+        Create a box for every tile of the map that has one, but the rock
+        boxes if they are merged into a wall.
+        """
+        for x in range(0, self.current_map.width):
+            for y in range(0,  self.current_map.height):
+                # Get the type of boxes
+                box_type = self.current_map.boxAt(x, y)
+                box_model = boxmodels.get_model(box_type)
+                # If the box model is non null, create a box
+                if box_model == boxmodels.rockbox and self.merge_rocks:
+                    continue
+                if(box_model != None):
+                    box = gameobjects.Box(
+                        x + 0.5, y + 0.5, box_model, self.space, self.grid
+                    )
+                    self.entities.add(box)
+                    if self.movement != None and box_model.movable:
+                        self.movement.add_box(box)
+
+
+    def create_tanks(self, players):
+        """
+        Create a base and a tank at every start position, all tanks but
+        the first players ones get an ai.
+        """
+        tank_sprites = assets.sprite("tanks")
+        base_sprites = assets.sprite("bases")
+
+        for i in range(0, len(self.current_map.start_positions)):
+            # Get the starting position of the tank "i"
+            pos = self.current_map.start_positions[i]
+
+            # Add base at starting position
+            base = gameobjects.GameVisibleObject(
+                pos[0], pos[1], base_sprites and base_sprites[i],
+                static = True
+            )
+            self.entities.add(base)
+
+            # Create the tank
+            tank = gameobjects.Tank(pos[0], pos[1], pos[2],
+                                    tank_sprites and tank_sprites[i],
+                                    self.space)
+
+            # Create an AI-instance for all the ai tanks
+            if i >= players:
+                ai_tank = ai.Ai(tank, self.entities, self.tanks_list,
+                                self.space, self.current_map,
+                                self.distance_fields, self.planner_pool,
+                                self.grid, self.targeting, self.random,
+                                self.shot_cooldown)
+                tank.ai = ai_tank
+                self.ai_list.add(ai_tank)
+
+            self.entities.add(tank)
+            if self.movement != None:
+                self.movement.add_tank(tank)
+            self.tanks_list.append(tank)
+
+
+    #----- Collision detection -----#
+
+    def add_collision_handlers(self):
+        """ Registers the collision handlers with the physics engine. """
+        # 1 : Bullet, 0: any
+        handler = self.space.add_collision_handler(1, 0)
+        handler.pre_solve = self.collision_bullet_any
+        # 1: Bullet, 2: Tank
+        handler = self.space.add_collision_handler(1, 2)
+        handler.pre_solve = self.collision_bullet_tank
+        # 1: Bullet, 3: Box
+        handler = self.space.add_collision_handler(1, 3)
+        handler.pre_solve = self.collision_bullet_box
+        # 1: Bullet, 1: Bullet
+        handler = self.space.add_collision_handler(1, 1)
+        handler.pre_solve = self.collision_bullet_bullet
+        # 2: Tank, 3: Box
+        handler = self.space.add_collision_handler(2, 3)
+        handler.begin = self.collision_tank_box
+
+
+    def collision_bullet_any(self, arb, space, data):
+        """Removes the bullet."""
+        bullet = arb.shapes[0].parent
+        if self.entities.destroy(bullet):
+            space.remove(arb.shapes[0], arb.shapes[0].body)
+        return True
+
+
+    def collision_bullet_tank(self, arb, space, data):
+        """
+        Removes the bullet and the tank from the game aswell as
+        respawns the tank.
+        """
+        assets.play_sound("tankboom_sound")
+
+        bullet = arb.shapes[0].parent
+        tank = arb.shapes[1].parent
+
+        if self.entities.destroy(bullet):
+            space.remove(arb.shapes[0], arb.shapes[0].body)
+
+        if tank.protection <= 0:
+            tank.hp -= 50
+            if tank.hp <= 0:
+                # Show Explosion
+                self.entities.add(
+                    gameobjects.Explosion(
+                        bullet.body.position.x, bullet.body.position.y)
+                )
+
+                bullet.tank.kills += 1
+                if tank.flag != None:
+                    bullet.tank.score += 10
+                else:
+                    bullet.tank.score += 5
+
+                tank.reset_position()
+                #  If the tank has an AI, reset AI
+                if tank.ai != None:
+                    tank.ai.reset()
+        return True
+
+
+    def collision_bullet_box(self, arb, space, data):
+        """Removes the bullet and the woodenbox from the game"""
+        bullet = arb.shapes[0].parent
+        box = arb.shapes[1].parent
+        wake_up(box.body)
+
+        if self.entities.destroy(bullet):
+            space.remove(arb.shapes[0], arb.shapes[0].body)
+
+        # Two bullets can hit the same box during a step
+        if box.boxmodel == boxmodels.woodbox and self.entities.destroy(box):
+            # Show Explosion
+            self.entities.add(
+                gameobjects.Explosion(bullet.body.position.x,
+                                      bullet.body.position.y)
+            )
+
+            bullet.tank.score += 1
+
+            space.remove(arb.shapes[1], arb.shapes[1].body)
+            if self.movement != None:
+                self.movement.remove_box(box)
+            self.grid.set_box(box.tile[0], box.tile[1], 0)
+            assets.play_sound("boxboom_sound")
+        return True
+
+
+    def collision_bullet_bullet(self, arb, space, data):
+        """Removes the two bullets when colliding"""
+        bullet_1 = arb.shapes[0].parent
+        bullet_2 = arb.shapes[1].parent
+
+        if self.entities.destroy(bullet_1):
+            space.remove(arb.shapes[0], arb.shapes[0].body)
+        if self.entities.destroy(bullet_2):
+            space.remove(arb.shapes[1], arb.shapes[1].body)
+        return True
+
+
+    def collision_tank_box(self, arb, space, data):
+        """Wakes up the box the tank drives into."""
+        wake_up(arb.shapes[1].body)
+        return True
+
+
+    #----- Simulation -----#
+
+    def shoot(self, tank):
+        """ Makes the tank shoot, if it is not cooling down. """
+        # Restrict shooting to one per second
+        if tank.cooldown == 0:
+            self.entities.add(tank.shoot(self.space))
+            tank.cooldown = self.shot_cooldown
+
+
+    def advance(self, elapsed):
+        """
+        Runs as many ticks as fit in elapsed seconds of real time plus
+        what was left over from the previous call, at most
+        MAX_TICKS_PER_ADVANCE. Returns the tank that won the last round
+        during these ticks, or None. Afterwards self.alpha tells how far
+        the real time is between the previous and the last tick, for
+        drawing the objects in between.
+        """
+        dt = 1 / self.physics_rate
+        self.accumulator += elapsed
+        winner = None
+        ticks = 0
+        while self.accumulator >= dt:
+            if ticks == MAX_TICKS_PER_ADVANCE:
+                # Drop the time we can't catch up with
+                self.accumulator = 0
+                break
+            winner = self.tick() or winner
+            self.accumulator -= dt
+            ticks += 1
+        self.alpha = self.accumulator / dt
+        return winner
+
+
+    def tick(self):
+        """
+        Advances the game by one tick of 1 / physics_rate seconds. The
+        objects update their speed and the ai decides only on the ticks
+        due at their own rates. Returns the tank that won a round during
+        the tick, or None. The round has already been reset when this
+        returns. The phases of the tick are the methods below, in the order
+        they are called, and are timed by self.profiler between its
+        start_tick() and end_tick().
+        """
+        profiler = self.profiler
+        self.control_time += self.control_rate
+        if self.control_time >= self.physics_rate:
+            self.control_time -= self.physics_rate
+            self.update_objects()
+            profiler.mark("update")
+        self.step_physics()
+        profiler.mark("step")
+        if profiler.active:
+            self.count_bodies()
+        self.post_update_objects()
+        profiler.mark("post_update")
+        self.ai_time += self.ai_rate
+        if self.ai_time >= self.physics_rate:
+            self.ai_time -= self.physics_rate
+            self.decide_ai()
+            profiler.mark("decide")
+        winner = self.check_flag()
+        profiler.mark("flag")
+        self.end_tick()
+        return winner
+
+
+    def update_objects(self):
+        """
+        Updates the speed of the objects in function of their
+        acceleration, the tanks and boxes in one batch if possible.
+        """
+        if self.movement != None:
+            self.movement.update()
+        for obj in self.entities.updating.values():
+            obj.update()
+
+
+    def step_physics(self):
+        """
+        Keeps the state of the moving objects for the interpolation, then
+        checks collisions and updates the objects position.
+        """
+        if self.interpolate:
+            for obj in self.entities.moving.values():
+                obj.save_state()
+        self.space.step(1 / self.physics_rate)
+
+
+    def count_bodies(self):
+        """
+        Gives the numbers of awake and sleeping bodies to the profiler.
+        They are counted every BODY_COUNT_INTERVAL ticks, in the count
+        phase, over the objects that can move, and the last counts are
+        given on the other ticks.
+        """
+        if self.body_counts == None or self.ticks % BODY_COUNT_INTERVAL == 0:
+            sleeping = 0
+            for obj in self.entities.moving.values():
+                if obj.body.is_sleeping:
+                    sleeping += 1
+            self.body_counts = (len(self.entities.moving) - sleeping, sleeping)
+            self.profiler.mark("count")
+        self.profiler.count("awake", self.body_counts[0])
+        self.profiler.count("sleeping", self.body_counts[1])
+
+
+    def post_update_objects(self):
+        """
+        Updates objects that depend on an other object position, the boxes
+        in one batch if possible, removes the explosions that are over, and
+        then the destroyed objects.
+        """
+        if self.movement != None:
+            self.movement.post_update()
+        for obj in self.entities.post_updating.values():
+            obj.post_update()
+        for explosion in self.entities.of_type(gameobjects.Explosion):
+            if explosion.duration_timer <= 0:
+                self.entities.destroy(explosion)
+        self.entities.flush()
+
+
+    def decide_ai(self):
+        """ Lets every ai aim and decide. """
+        self.targeting.aim_all(self.ai_list)
+        self.profiler.mark("aim")
+        self.ai_scheduler.run(self.ai_list)
+
+
+    def check_flag(self):
+        """
+        Lets the tanks grab the flag, and returns the tank that has won
+        the round if any.
+        """
+        winner = None
+        for tank in self.tanks_list:
+            tank.try_grab_flag(self.flag)
+            if tank.has_won():
+                assets.play_sound("win_sound")
+                winner = tank
+                self.reset_round()
+        return winner
+
+
+    def end_tick(self):
+        """ Counts the tick, records and forgets the controls used in it. """
+        self.ticks += 1
+        if self.recorder != None:
+            self.recorder.record(self)
+        for tank in self.tanks_list:
+            tank.actions = 0
+
+
+    def reset_round(self):
+        """ Puts every tank, and the flag, back at its starting position. """
+        self.rounds += 1
+        for tank in self.tanks_list:
+            tank.reset_position()
+            if tank.ai != None:
+                tank.ai.reset()
+
+        # Respawn the flag
+        self.flag.reset_position()
+
+
+    def checksum(self):
+        """
+        Returns a CRC-32 of the positions and speeds of the game objects and
+        of the state of the tanks, to check that two runs are identical.
+        """
+        state = bytearray()
+        for obj in self.entities:
+            if isinstance(obj, gameobjects.GamePhysicsObject):
+                body = obj.body
+                state += struct.pack(
+                    "<6d", body.position.x, body.position.y, body.angle,
+                    body.velocity.x, body.velocity.y, body.angular_velocity
+                )
+        for tank in self.tanks_list:
+            state += struct.pack("<4i", tank.score, tank.hp, tank.cooldown,
+                                 tank.flag != None)
+        state += struct.pack("<2d", self.flag.x, self.flag.y)
+        return zlib.crc32(state)
+
+
+    def close(self):
+        """
+        Stops the planner processes, if any, and loads images and sounds
+        again if they were before this world was made headless.
+        """
+        if self.planner_pool != None:
+            self.planner_pool.shutdown()
+        assets.HEADLESS = self.was_headless
+
+
+def wake_up(body):
+    """
+    Wakes up the body if it is a sleeping dynamic body. Waking a body in
+    the middle of a step can make Chipmunk loop forever, so from the
+    collision handlers it is done once the step is over.
+    """
+    if body.body_type == pymunk.Body.DYNAMIC and body.is_sleeping:
+        body.space.add_post_step_callback(activate, body)
+
+
+def activate(space, body):
+    # The body may have been removed during the step
+    if body.space == space and body.is_sleeping:
+        body.activate()
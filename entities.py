@@ -0,0 +1,121 @@
+import gameobjects
+import pymunk
+
+
+class EntityRegistry:
+    """
+    All the game objects, each with a stable id, iterated in the order
+    they were added. Objects are also kept per type, and apart when their
+    class has an update or a post_update or when they have a body that can
+    move, so that the phases of a tick only visit the objects that need
+    them. The scenery is kept apart from the other objects, the actors,
+    for the renderer. Destroying an object only queues it; the queue is
+    flushed once per tick, so it is safe to destroy objects while
+    iterating, for instance from the collision handlers.
+    """
+
+    def __init__(self, batched = (), post_batched = ()):
+        """
+        The update of the objects of the batched classes, and the
+        post_update of those of the post_batched classes, is done by a
+        movement.MovementStore, so they are not kept apart for it.
+        """
+        self.batched        = batched
+        self.post_batched   = post_batched
+        self.next_id        = 1
+        self.entities       = {}
+        self.types          = {}
+        self.updating       = {}
+        self.post_updating  = {}
+        self.moving         = {}
+        self.scenery        = {}
+        self.actors         = {}
+        # Changes every time scenery is added or removed
+        self.scenery_version = 0
+        # Objects to remove at the next flush(), by id
+        self.pending        = {}
+
+
+    def add(self, obj):
+        """ Registers the object, gives it an entity_id and returns obj. """
+        entity_id = self.next_id
+        self.next_id += 1
+        obj.entity_id = entity_id
+        self.entities[entity_id] = obj
+
+        cls = type(obj)
+        bucket = self.types.get(cls)
+        if bucket == None:
+            bucket = self.types[cls] = {}
+        bucket[entity_id] = obj
+        if cls.update is not gameobjects.GameObject.update \
+                and cls not in self.batched:
+            self.updating[entity_id] = obj
+        if cls.post_update is not gameobjects.GameObject.post_update \
+                and cls not in self.post_batched:
+            self.post_updating[entity_id] = obj
+        body = getattr(obj, "body", None)
+        if body != None and body.body_type == pymunk.Body.DYNAMIC:
+            self.moving[entity_id] = obj
+        if obj.static:
+            self.scenery[entity_id] = obj
+            self.scenery_version += 1
+        else:
+            self.actors[entity_id] = obj
+        return obj
+
+
+    def destroy(self, obj):
+        """
+        Queues the object for removal. Returns False if it was already
+        destroyed, so that its body is only removed from the space once.
+        """
+        if not self.alive(obj):
+            return False
+        self.pending[obj.entity_id] = obj
+        return True
+
+
+    def alive(self, obj):
+        """ True if the object is registered and not destroyed. """
+        entity_id = getattr(obj, "entity_id", None)
+        return entity_id in self.entities and entity_id not in self.pending
+
+
+    def flush(self):
+        """ Removes the destroyed objects, call this once per tick. """
+        for entity_id, obj in self.pending.items():
+            del self.entities[entity_id]
+            del self.types[type(obj)][entity_id]
+            self.updating.pop(entity_id, None)
+            self.post_updating.pop(entity_id, None)
+            self.moving.pop(entity_id, None)
+            self.actors.pop(entity_id, None)
+            if self.scenery.pop(entity_id, None) != None:
+                self.scenery_version += 1
+        self.pending.clear()
+
+
+    def get(self, entity_id):
+        """ Returns the object with the id, or None if it is gone. """
+        return self.entities.get(entity_id)
+
+
+    def of_type(self, cls):
+        """ Returns the objects whose class is exactly cls. """
+        bucket = self.types.get(cls)
+        if bucket == None:
+            return []
+        return bucket.values()
+
+
+    def __contains__(self, obj):
+        return self.alive(obj)
+
+
+    def __iter__(self):
+        return iter(self.entities.values())
+
+
+    def __len__(self):
+        return len(self.entities)
@@ -1,22 +1,89 @@
-import images
+import assets
+import movement
 import pygame
 import pymunk
 import math
-import sounds
-import ctf
+from collections import OrderedDict
 
 # Change this to set it in debug mode 
 DEBUG = False 
 
+# The sprites are drawn at angles rounded to ROTATION_STEP degrees, and at
+# most MAX_ROTATED_SPRITES rotated sprites are kept
+ROTATION_STEP = 2
+MAX_ROTATED_SPRITES = 2048
+
+# -- The layers the objects are drawn in, from the bottom up. The fog of war
+#    and the panels are drawn over the last one.
+SCENERY_LAYER   = 0
+BASE_LAYER      = 1
+TANK_LAYER      = 2
+BULLET_LAYER    = 3
+FLAG_LAYER      = 4
+EXPLOSION_LAYER = 5
+
 
 def physics_to_display(x):
     """ Convert physics engine coordinates into the display coordinates. """
-    return x * images.TILE_SIZE
+    return x * assets.TILE_SIZE
+
+
+class RotationCache:
+    """
+    The rotated sprites, by sprite and angle rounded to a multiple of
+    step degrees. The max_size least recently used are kept. Sprites that
+    are not rotated are returned as they are.
+    """
+
+    def __init__(self, step = ROTATION_STEP, max_size = MAX_ROTATED_SPRITES):
+        self.step       = step
+        self.max_size   = max_size
+        self.sprites    = OrderedDict()
+        # Number of rotations found in the cache, and not, since pop_stats()
+        self.hits       = 0
+        self.misses     = 0
+
+
+    def rotate(self, sprite, angle):
+        """ Returns the sprite rotated by angle degrees, counterclockwise. """
+        angle = round(angle / self.step) * self.step % 360
+        if angle == 0:
+            return sprite
+        key = (sprite, angle)
+        rotated = self.sprites.get(key)
+        if rotated != None:
+            self.hits += 1
+            self.sprites.move_to_end(key)
+            return rotated
+
+        self.misses += 1
+        rotated = pygame.transform.rotate(sprite, angle)
+        self.sprites[key] = rotated
+        if len(self.sprites) > self.max_size:
+            self.sprites.popitem(last=False)
+        return rotated
+
+
+    def pop_stats(self):
+        """ Returns the hits and misses since the last call, and resets. """
+        stats = self.hits, self.misses
+        self.hits = self.misses = 0
+        return stats
+
+
+# -- Used by all the game objects
+rotation_cache = RotationCache()
 
 
 class GameObject:
     """ Handles all of objects in the game. """
 
+    # True for scenery, objects that never move nor change, which are drawn
+    # once onto the static layer of the renderer instead of every frame
+    static = False
+    # The layer the object is drawn in
+    layer = SCENERY_LAYER
+
     def __init__(self, sprite):
         self.sprite         = sprite
 
@@ -33,25 +100,36 @@ class GameObject:
         return
         
 
-    def update_screen(self, screen):
+    def update_screen(self, screen, alpha = 1.0):
         """ 
         Updates the visual part of the game. Should NOT need to be changed
-        by a subclass.
+        by a subclass. Alpha is how far the display is between the
+        previous and the current tick, from 0 to 1. Returns the rectangle
+        of the screen that was drawn.
+        """
+        sprite, rect = self.screen_sprite(alpha)
+
+        # Copy the sprite on the screen
+        return screen.blit(sprite, rect)
+
+
+    def screen_sprite(self, alpha = 1.0):
+        """
+        Returns the sprite as it is drawn on the screen, rotated, and the
+        rectangle of the screen it is drawn on.
         """
         sprite = self.sprite
         
         # Get the position of the object (pygame coordinates)
-        p = self.screen_position() 
+        p = self.screen_position(alpha) 
         
         # Rotate the sprite using the rotation of the object
-        sprite = pygame.transform.rotate(sprite, self.screen_orientation()) 
+        sprite = rotation_cache.rotate(sprite, self.screen_orientation(alpha))
         
         # Offsets the coordinates to the upper left corner
-        offset = pymunk.Vec2d(sprite.get_size()[0], sprite.get_size()[1]) / 2.
-        p = p - offset
-
-        # Copy the sprite on the screen
-        screen.blit(sprite, p) 
+        width, height = sprite.get_size()
+        return sprite, pygame.Rect(int(p[0] - width / 2),
+                                   int(p[1] - height / 2), width, height)
         
 
 
@@ -62,19 +140,20 @@ class GamePhysicsObject(GameObject):
     interaction of the objects.
     """
         
-    def __init__(self, x, y, orientation, sprite, space, movable):
+    def __init__(self, x, y, orientation, sprite, space, movable, size):
         """ Takes as parameters the starting coordinate (x,y),
             the orientation, the sprite (aka the image
-            representing the object), the physic engine object (space)
-            and whether the object can be moved (movable).
+            representing the object), the physic engine object (space),
+            whether the object can be moved (movable) and the width of
+            its square shape in physic coordinates (size). The sprite is
+            None when the game is headless.
         """
 
         super().__init__(sprite)
 
-        # Half dimensions of the object converted from screen coordinates 
-        # to physic coordinates
-        half_width          = 0.5 * self.sprite.get_width() / images.TILE_SIZE
-        half_height         = 0.5 * self.sprite.get_height() / images.TILE_SIZE
+        # Half dimensions of the object in physic coordinates
+        half_width          = 0.5 * size
+        half_height         = 0.5 * size
 
         # Physical objects have a rectangular shape, the points correspond 
         # to the corners of that shape.
@@ -95,43 +174,57 @@ class GamePhysicsObject(GameObject):
         self.body.position  = x, y
         self.body.angle     = math.radians(orientation)
         self.shape          = pymunk.Poly(self.body, points)
+        self.save_state()
 
         # Set value for friction and elasticity
         self.shape.friction = 0.5
         self.shape.elasticity = 0.1
 
         # Add the object to the physic engine
-        if(movable):
-            ctf.space.add(self.body, self.shape)
-        else:
-            ctf.space.add(self.body, self.shape)
+        space.add(self.body, self.shape)
     
 
-    def screen_position(self):
+    def save_state(self):
+        """ 
+        Keeps the position and angle of the body before a physics step,
+        to interpolate between them and the new ones when drawing.
+        """
+        self.previous_position  = self.body.position
+        self.previous_angle     = self.body.angle
+
+
+    def screen_position(self, alpha = 1.0):
         """ 
         Converts the body's position in the 
         physics engine to screen coordinates. 
         """
-        return physics_to_display(self.body.position)
+        if alpha == 1.0:
+            return physics_to_display(self.body.position)
+        return physics_to_display(
+            self.previous_position.interpolate_to(self.body.position, alpha)
+        )
     
     
-    def screen_orientation(self):
+    def screen_orientation(self, alpha = 1.0):
         """ Angles are reversed from the engine to the display. """
-        return -math.degrees(self.body.angle)
+        angle = self.previous_angle \
+            + (self.body.angle - self.previous_angle) * alpha
+        return -math.degrees(angle)
 
 
-    def update_screen(self, screen):
+    def update_screen(self, screen, alpha = 1.0):
         """ Updates the screen. """
-        super().update_screen(screen)
+        rect = super().update_screen(screen, alpha)
         # debug draw 
         if DEBUG:
             ps = [self.body.position+p for p in self.points]
 
             ps = [physics_to_display(p) for p in ps]
             ps += [ps[0]]
-            pygame.draw.lines(
+            rect = rect.union(pygame.draw.lines(
                 screen, pygame.color.THECOLORS["red"], False, ps, 1
-            )
+            ))
+        return rect
 
 def clamp (minval, val, maxval):
     """ Convenient helper function to bound a value to a specific interval. """
@@ -145,23 +238,48 @@ class Tank(GamePhysicsObject):
     Extends GamePhysicsObject and 
     handles aspects which are specific to our tanks. 
     """
+    layer = TANK_LAYER
 
     # Constant values for the tank, acessed like: Tank.ACCELERATION
     ACCELERATION = 0.4
     NORMAL_MAX_SPEED = 2.0
     FLAG_MAX_SPEED = NORMAL_MAX_SPEED * 0.5
+    SIZE = 0.5
+
+    # Bits of Tank.actions, the controls used during the current tick.
+    # A stop followed by a new move within a tick keeps both bits.
+    STOP_MOVING  = 1
+    ACCELERATE   = 2
+    DECELERATE   = 4
+    STOP_TURNING = 8
+    TURN_LEFT    = 16
+    TURN_RIGHT   = 32
+    SHOOT        = 64
+
+    # The movement state, kept in the arrays of a movement.MovementStore
+    # once the tank has been added to one
+    velocity             = movement.Field()
+    angular_velocity     = movement.Field()
+    acceleration         = movement.Field()
+    angular_acceleration = movement.Field()
+    maximum_speed        = movement.Field()
     
     def __init__(self, x, y, orientation, sprite, space):
-        super().__init__(x, y, orientation, sprite, space, True)
+        super().__init__(x, y, orientation, sprite, space, True, Tank.SIZE)
+        self.movement             = None
+        self.movement_index       = None
         # Define variable used to apply motion to the tanks
         self.acceleration         = 0.0
         self.velocity             = 0.0
         self.angular_acceleration = 0.0
         self.angular_velocity     = 0.0
+        self.actions              = 0
 
         self.ai = None
 
         self.score                = 0
+        self.captures             = 0
+        self.kills                = 0
         self.flag                 = None                      
         self.maximum_speed        = Tank.NORMAL_MAX_SPEED
         self.start_position       = pymunk.Vec2d(x, y)
@@ -178,21 +296,25 @@ class Tank(GamePhysicsObject):
     def accelerate(self):
         """ Call this function to make the tank move forward. """
         self.acceleration = Tank.ACCELERATION
+        self.actions = (self.actions & ~Tank.DECELERATE) | Tank.ACCELERATE
     
 
     def decelerate(self):
         """ Call this function to make the tank move backward. """
         self.acceleration = -Tank.ACCELERATION
+        self.actions = (self.actions & ~Tank.ACCELERATE) | Tank.DECELERATE
     
     # 
     def turn_left(self):
         """ Makes the tank turn left (counter clock-wise). """
         self.angular_acceleration = -Tank.ACCELERATION
+        self.actions = (self.actions & ~Tank.TURN_RIGHT) | Tank.TURN_LEFT
 
 
     def turn_right(self):
         """ Makes the tank turn right (clock-wise). """
         self.angular_acceleration = Tank.ACCELERATION
+        self.actions = (self.actions & ~Tank.TURN_LEFT) | Tank.TURN_RIGHT
     
     def update(self):
         """ A function to update the objects coordinates.
@@ -231,12 +353,16 @@ class Tank(GamePhysicsObject):
         """ Call this function to make the tank stop moving. """
         self.velocity     = 0
         self.acceleration = 0
+        self.actions = (self.actions & ~(Tank.ACCELERATE | Tank.DECELERATE)) \
+            | Tank.STOP_MOVING
     
     
     def stop_turning(self):
         """ Call this function to make the tank stop turning. """
         self.angular_velocity     = 0
         self.angular_acceleration = 0
+        self.actions = (self.actions & ~(Tank.TURN_LEFT | Tank.TURN_RIGHT)) \
+            | Tank.STOP_TURNING
     
     
     def post_update(self):
@@ -273,7 +399,7 @@ class Tank(GamePhysicsObject):
             flag_pos = pymunk.Vec2d(flag.x, flag.y)
             if((flag_pos - self.body.position).length < 0.5):
                 # Grab the flag !
-                pygame.mixer.Sound.play(sounds.pickup_sound)
+                assets.play_sound("pickup_sound")
                 self.flag           = flag
                 flag.is_on_tank     = True
                 self.maximum_speed  = Tank.FLAG_MAX_SPEED
@@ -287,13 +413,15 @@ class Tank(GamePhysicsObject):
         if self.flag != None and \
             (self.start_position - self.body.position).length < 0.2:
             self.score += 100
+            self.captures += 1
             return True
         return False
 
 
     def shoot(self, space):
         """ Call this function to shoot a bullet. """
-        pygame.mixer.Sound.play(sounds.shoot_sound)
+        assets.play_sound("shoot_sound")
+        self.actions |= Tank.SHOOT
         return Bullet(
                 self.body.position[0], 
                 self.body.position[1], 
@@ -306,6 +434,8 @@ class Tank(GamePhysicsObject):
         """ Resets the tanks position. """
         self.body.position = self.start_position
         self.body.angle = math.radians(self.start_orientation)
+        # Do not draw the tank on its way back to the start
+        self.save_state()
         self.hp = 100
         self.protection = 100
         
@@ -316,13 +446,15 @@ class Tank(GamePhysicsObject):
 
 class Bullet(GamePhysicsObject):
      """ Extends the GamePhysicsObject to handle bullets. """
+     layer = BULLET_LAYER
      VELOCITY = 3
+     SIZE = 0.25
      
      def __init__(self, x, y, rotation, space, tank):
         super().__init__(
             x+math.cos(rotation + math.pi/2)*0.4,
             y+math.sin(rotation + math.pi/2)*0.4,
-            rotation, images.bullet, space, True
+            rotation, assets.sprite("bullet"), space, True, Bullet.SIZE
             )
         self.body.velocity = pymunk.Vec2d(0, self.VELOCITY).rotated(rotation)
         self.body.angle = rotation
@@ -333,17 +465,23 @@ class Bullet(GamePhysicsObject):
 
 class Box(GamePhysicsObject):
     """ This class extends the GamePhysicsObject to handle box objects. """
+    SIZE = 1.0
 
-    def __init__(self, x, y, boxmodel, space):
+    def __init__(self, x, y, boxmodel, space, grid = None):
         """ 
         It takes as arguments the coordinate of the starting position 
-        of the box (x,y) and the box model (boxmodel). 
+        of the box (x,y) and the box model (boxmodel). If an
+        occupancy.OccupancyGrid is given it is kept up to date when the
+        box is pushed onto another tile.
         """
         self.boxmodel = boxmodel
         super().__init__(
             x, y, 0,
-            self.boxmodel.sprite, space, self.boxmodel.movable
+            self.boxmodel.sprite, space, self.boxmodel.movable, Box.SIZE
             )
+        self.grid = grid
+        self.tile = (int(x), int(y))
+        self.static = not boxmodel.movable
 
         # Collision detection
         self.shape.collision_type = 3
@@ -351,9 +489,77 @@ class Box(GamePhysicsObject):
     
     
     def update(self):
-        """ Updates the friction of the movable boxes. """
-        self.body.velocity *= 0.9
-        self.body.angular_velocity *= 0.9
+        """
+        Updates the friction of the movable boxes. A box slower than the
+        idle speed of the space is stopped, and a box at rest is left
+        alone, as setting its speed would wake it up.
+        """
+        body = self.body
+        if body.is_sleeping or (body.velocity == (0, 0)
+                                and body.angular_velocity == 0):
+            return
+        velocity = body.velocity * 0.9
+        angular_velocity = body.angular_velocity * 0.9
+        idle_speed = body.space.idle_speed_threshold
+        if velocity.length < idle_speed and abs(angular_velocity) < idle_speed:
+            velocity, angular_velocity = (0, 0), 0
+        body.velocity = velocity
+        body.angular_velocity = angular_velocity
+
+
+    def post_update(self):
+        """ Moves the box in the grid when it has been pushed to a new tile. """
+        if self.grid != None and self.boxmodel.movable \
+                and not self.body.is_sleeping:
+            x, y = self.body.position
+            tile = (int(x), int(y))
+            if tile != self.tile:
+                self.grid.move_box(self.tile, tile, self.boxmodel.type)
+                self.tile = tile
+
+
+class Wall(GameObject):
+    """
+    The boxes of a map that never move, merged into rectangles on one
+    static body, so that the physics has a few large shapes to check
+    instead of one per tile. Bullets and tanks hit it like a box.
+    """
+    static = True
+
+    def __init__(self, rectangles, boxmodel, space):
+        """
+        Takes the (x, y, width, height) rectangles of tiles covered by
+        boxes of the box model (boxmodel), see maps.Map.rectangles.
+        """
+        super().__init__(boxmodel.sprite)
+        self.boxmodel = boxmodel
+        self.body = pymunk.Body(body_type=pymunk.Body.STATIC)
+        self.shapes = []
+        # The upper left corners of the tiles, to draw them one by one
+        self.tiles = []
+
+        for x, y, width, height in rectangles:
+            shape = pymunk.Poly(self.body, [
+                (x, y), (x, y + height), (x + width, y + height),
+                (x + width, y)
+            ])
+            shape.friction = 0.5
+            shape.elasticity = 0.1
+            shape.collision_type = 3
+            shape.parent = self
+            self.shapes.append(shape)
+            self.tiles += [(i, j) for j in range(y, y + height)
+                           for i in range(x, x + width)]
+
+        space.add(self.body, *self.shapes)
+
+
+    def update_screen(self, screen, alpha = 1.0):
+        """ Draws the box sprite on every tile. """
+        rects = [screen.blit(self.sprite,
+                             (physics_to_display(x), physics_to_display(y)))
+                 for x, y in self.tiles]
+        return rects[0].unionall(rects)
 
 
 class GameVisibleObject(GameObject):
@@ -361,38 +567,54 @@ class GameVisibleObject(GameObject):
     This class extends GameObject for object that are visible on screen 
     but have no physical representation (bases and flag).
     """
+    layer = BASE_LAYER
 
-    def __init__(self, x, y, sprite):
-        """ It takes argument the coordinates (x,y) and the sprite. """
+    def __init__(self, x, y, sprite, static = False):
+        """
+        It takes argument the coordinates (x,y) and the sprite, and
+        whether the object is scenery (see GameObject.static).
+        """
         self.x            = x
         self.y            = y
         self.orientation  = 0
+        self.static       = static
         super().__init__(sprite)
 
 
-    def screen_position(self):
+    def screen_position(self, alpha = 1.0):
         """ Returns the screen position of object """
         return physics_to_display(pymunk.Vec2d(self.x, self.y))
 
 
-    def screen_orientation(self):
+    def screen_orientation(self, alpha = 1.0):
         """ Returns the orientation of object. """
         return self.orientation
 
 
 class Flag(GameVisibleObject):
     """ This class extends GameVisibleObject for representing flags."""
+    layer = FLAG_LAYER
 
     def __init__(self, x, y):
-        super().__init__(x, y,  images.flag)
+        super().__init__(x, y,  assets.sprite("flag"))
+        self.is_on_tank   = False
+        self.start_position = pymunk.Vec2d(x, y)
+
+
+    def reset_position(self):
+        """ Puts the flag back at its starting position. """
+        self.x, self.y    = self.start_position
+        self.orientation  = 0
         self.is_on_tank   = False
 
 
 class Explosion(GameVisibleObject):
     """ This class extends GameVisibleObject for repressenting Explosions. """
+    layer = EXPLOSION_LAYER
+
     def __init__(self, x, y):
         """ Takes the coordinates of the explosion. """
-        super().__init__(x, y,  images.explosion)
+        super().__init__(x, y,  assets.sprite("explosion"))
         self.duration_timer = 25
 
 
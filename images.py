@@ -1,5 +1,6 @@
 import pygame
 import os
+from assets import TILE_SIZE  # The default size of tiles, used by the game
 
 # --Reference to current directory.
 main_dir = os.path.split(os.path.abspath(__file__))[0]
@@ -16,8 +17,6 @@ def load_image(file):
     return surface.convert_alpha()
 
 
-TILE_SIZE = 40  # Define the default size of tiles
-
 explosion = pygame.image.load('data/explosion.png')  # Image of an explosion
 
 
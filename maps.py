@@ -1,4 +1,4 @@
-import images
+import assets
 import pygame
 import json
 import os
@@ -24,7 +24,7 @@ class Map:
   def rect(self):
     """ Returns rectangle object of map. """
     return pygame.Rect(
-      0, 0, images.TILE_SIZE*self.width, images.TILE_SIZE*self.height
+      0, 0, assets.TILE_SIZE*self.width, assets.TILE_SIZE*self.height
     )
   
   
@@ -33,6 +33,37 @@ class Map:
     return self.boxes[y][x]
 
 
+  def rectangles(self, box_type):
+    """
+    Covers the tiles with boxes of box_type with rectangles that do not
+    overlap, returned as (x, y, width, height) tuples. The merge is
+    greedy: from the top row down, every row is cut into runs of such
+    tiles that are not covered yet, and each run is extended down as
+    long as the row below has the same tiles over the whole run. Walls
+    and blocks take few rectangles, but not always the fewest possible.
+    """
+    covered = set()
+    rectangles = []
+    for y in range(self.height):
+      row = self.boxes[y]
+      x = 0
+      while x < self.width:
+        if row[x] != box_type or (x, y) in covered:
+          x += 1
+          continue
+        start = x
+        while x < self.width and row[x] == box_type and (x, y) not in covered:
+          x += 1
+        height = 1
+        while y + height < self.height and all(
+            self.boxes[y + height][i] == box_type for i in range(start, x)):
+          height += 1
+        covered.update((i, j) for i in range(start, x)
+                       for j in range(y, y + height))
+        rectangles.append((start, y, x - start, height))
+    return rectangles
+
+
 #--Reference to current directory.
 main_dir = os.path.split(os.path.abspath(__file__))[0]
   
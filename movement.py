@@ -0,0 +1,231 @@
+"""
+Batch update of the speed of the tanks and of the movable boxes. The
+movement state of the tanks is kept as arrays, one per attribute, and the
+body velocities are read from pymunk in one call, so that Tank.update and
+Box.update can be done with a few NumPy operations for all the objects.
+NumPy is optional, without it the objects update themselves one by one.
+"""
+try:
+    import numpy
+    from pymunk import batch
+except ImportError:
+    numpy = None
+
+# True if the batch update can be used
+available = numpy != None
+
+# The movement attributes of a tank that are kept in the store
+TANK_FIELDS = ["velocity", "angular_velocity", "acceleration",
+               "angular_acceleration", "maximum_speed"]
+
+# Same as in Box.update
+BOX_DAMPING = 0.9
+
+
+class Field:
+    """
+    A movement attribute of a tank. It is kept in the arrays of the
+    MovementStore of the tank, or in the tank itself if it has no store.
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+
+    def __get__(self, tank, owner):
+        if tank == None:
+            return self
+        store = tank.movement
+        if store == None:
+            return tank.__dict__[self.name]
+        return float(store.arrays[self.name][tank.movement_index])
+
+
+    def __set__(self, tank, value):
+        store = tank.movement
+        if store == None:
+            tank.__dict__[self.name] = value
+        else:
+            store.arrays[self.name][tank.movement_index] = value
+
+
+class MovementStore:
+    """
+    The movement state of the tanks, as one array per attribute, and the
+    movable boxes of a space. Rock boxes are never added, so they are
+    skipped entirely. Boxes slower than the idle speed threshold of the
+    space are stopped, and the boxes at rest are not written back, so
+    that they can fall asleep.
+    """
+
+    def __init__(self, space):
+        self.space = space
+        self.tanks = []
+        self.arrays = {name: numpy.zeros(0) for name in TANK_FIELDS}
+        self.tank_ids = numpy.zeros(0, dtype=numpy.int64)
+
+        # -- The movable boxes by body id, the arrays are rebuilt on change
+        self.boxes = {}
+        self.box_list = []
+        self.box_ids = numpy.zeros(0, dtype=numpy.int64)
+        self.box_tiles = numpy.zeros((0, 2))
+        self.boxes_changed = False
+
+        self.buffer = batch.Buffer()
+        self.fields = batch.BodyFields.BODY_ID | batch.BodyFields.ANGLE \
+            | batch.BodyFields.VELOCITY | batch.BodyFields.ANGULAR_VELOCITY
+        self.position_fields = batch.BodyFields.BODY_ID \
+            | batch.BodyFields.POSITION
+
+
+    def add_tank(self, tank):
+        """ Moves the movement state of the tank into the store. """
+        values = {name: getattr(tank, name) for name in TANK_FIELDS}
+        for name in TANK_FIELDS:
+            self.arrays[name] = numpy.append(self.arrays[name], values[name])
+        tank.movement = self
+        tank.movement_index = len(self.tanks)
+        self.tanks.append(tank)
+        self.tank_ids = numpy.append(self.tank_ids, tank.body.id)
+
+
+    def add_box(self, box):
+        """ Adds a movable box. """
+        self.boxes[box.body.id] = box
+        self.boxes_changed = True
+
+
+    def remove_box(self, box):
+        """ Removes a box, call this when it is destroyed. """
+        if self.boxes.pop(box.body.id, None) != None:
+            self.boxes_changed = True
+
+
+    def rows_of(self, ids, wanted):
+        """
+        Returns the rows of the bodies with the wanted ids in the ids read
+        from the space, and which of the wanted ids were found.
+        """
+        order = numpy.argsort(ids)
+        positions = numpy.searchsorted(ids, wanted, sorter=order)
+        positions = numpy.minimum(positions, len(ids) - 1)
+        rows = order[positions]
+        return rows, ids[rows] == wanted
+
+
+    def read_bodies(self, fields, width):
+        """
+        Returns the ids of all the bodies of the space, and the given
+        fields of them as an array with width floats per body.
+        """
+        self.buffer.clear()
+        batch.get_space_bodies(self.space, fields, self.buffer)
+        ids = numpy.frombuffer(self.buffer.int_buf(), dtype=numpy.int64)
+        data = numpy.frombuffer(self.buffer.float_buf(), dtype=numpy.float64)
+        return ids, data.reshape(len(ids), width)
+
+
+    def rebuild_boxes(self):
+        """ Rebuilds the arrays of the boxes after some were added or removed. """
+        self.box_list = list(self.boxes.values())
+        self.box_ids = numpy.array([box.body.id for box in self.box_list],
+                                   dtype=numpy.int64)
+        self.box_tiles = numpy.array([box.tile for box in self.box_list],
+                                     dtype=numpy.float64).reshape(-1, 2)
+        self.boxes_changed = False
+
+
+    def update(self):
+        """ Does Tank.update for every tank and Box.update for every box. """
+        ids, data = self.read_bodies(self.fields, 4)
+        if len(ids) == 0:
+            return
+        if self.tanks:
+            self.update_tanks(ids, data)
+        if self.boxes:
+            self.update_boxes(ids, data)
+
+
+    def post_update(self):
+        """
+        Does Box.post_update for the boxes that have been pushed onto
+        another tile, the others are skipped.
+        """
+        if not self.boxes:
+            return
+        if self.boxes_changed:
+            self.rebuild_boxes()
+        ids, data = self.read_bodies(self.position_fields, 2)
+        rows, found = self.rows_of(ids, self.box_ids)
+        # int() of Box.post_update truncates
+        tiles = numpy.trunc(data[rows])
+        moved = found & numpy.any(tiles != self.box_tiles, axis=1)
+        for index in numpy.flatnonzero(moved).tolist():
+            box = self.box_list[index]
+            box.post_update()
+            self.box_tiles[index] = box.tile
+
+
+    def update_tanks(self, ids, data):
+        """ The velocity clamp and rotation of Tank.update, for all tanks. """
+        rows, found = self.rows_of(ids, self.tank_ids)
+        angle = data[rows, 0]
+        body_speed = numpy.sqrt(data[rows, 1] ** 2 + data[rows, 2] ** 2)
+        body_angular = data[rows, 3]
+
+        arrays = self.arrays
+        velocity = arrays["velocity"]
+        angular = arrays["angular_velocity"]
+        maximum = arrays["maximum_speed"]
+
+        # Update the velocity of the tank in function of the physic simulation
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            velocity = numpy.where(
+                velocity != 0, velocity * (body_speed / numpy.abs(velocity)),
+                velocity)
+            angular = numpy.where(
+                angular != 0, angular * numpy.abs(body_angular / angular),
+                angular)
+
+        # Update the velocity in function of the acceleration, and make sure
+        # it is not larger than a maximum speed
+        velocity = numpy.clip(velocity + arrays["acceleration"],
+                              -maximum, maximum)
+        angular = numpy.clip(angular + arrays["angular_acceleration"],
+                             -maximum, maximum)
+        arrays["velocity"] = velocity
+        arrays["angular_velocity"] = angular
+
+        # Update the physic velocity, Vec2d(0, velocity).rotated(angle)
+        velocity_x = -(velocity * numpy.sin(angle))
+        velocity_y = velocity * numpy.cos(angle)
+        for i, tank in enumerate(self.tanks):
+            if found[i]:
+                tank.body.velocity = (velocity_x[i], velocity_y[i])
+                tank.body.angular_velocity = angular[i]
+
+
+    def update_boxes(self, ids, data):
+        """
+        The damping of Box.update, for the movable boxes that move. Boxes
+        slower than the idle speed are stopped.
+        """
+        if self.boxes_changed:
+            self.rebuild_boxes()
+
+        rows, found = self.rows_of(ids, self.box_ids)
+        moving = found & ((data[rows, 1] != 0) | (data[rows, 2] != 0)
+                          | (data[rows, 3] != 0))
+        indices = numpy.flatnonzero(moving)
+        if len(indices) == 0:
+            return
+        damped = data[rows[indices], 1:4] * BOX_DAMPING
+        idle_speed = self.space.idle_speed_threshold
+        resting = (damped[:, 0] ** 2 + damped[:, 1] ** 2 < idle_speed ** 2) \
+            & (numpy.abs(damped[:, 2]) < idle_speed)
+        damped[resting] = 0
+        for index, (velocity_x, velocity_y, angular) in zip(
+                indices.tolist(), damped.tolist()):
+            body = self.box_list[index].body
+            body.velocity = (velocity_x, velocity_y)
+            body.angular_velocity = angular
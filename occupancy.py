@@ -0,0 +1,46 @@
+from array import array
+
+
+class OccupancyGrid:
+    """
+    The box type of every tile while the game is running. Unlike
+    maps.Map.boxes it follows boxes that are destroyed or pushed onto
+    another tile. Every change increases version and records the tile as
+    dirty, so that cached paths can be invalidated.
+    """
+
+    def __init__(self, currentmap):
+        """ Copies the boxes of the map into a flat array of box types. """
+        self.width   = currentmap.width
+        self.height  = currentmap.height
+        self.cells   = array("b", [box_type for row in currentmap.boxes
+                                   for box_type in row])
+        self.version = 0
+        # Maps every tile that has changed to the version it changed in.
+        self.dirty   = {}
+
+
+    def boxAt(self, x, y):
+        """ Return the type of the box at coordinates (x, y). """
+        return self.cells[y * self.width + x]
+
+
+    def set_box(self, x, y, box_type):
+        """ Changes the box type of the tile (x, y). """
+        index = y * self.width + x
+        if self.cells[index] != box_type:
+            self.cells[index] = box_type
+            self.version += 1
+            self.dirty[(x, y)] = self.version
+
+
+    def move_box(self, old_tile, new_tile, box_type):
+        """ Call this when a box has crossed the border between two tiles. """
+        self.set_box(old_tile[0], old_tile[1], 0)
+        self.set_box(new_tile[0], new_tile[1], box_type)
+
+
+    def dirty_since(self, version):
+        """ Returns the set of tiles that changed after the given version. """
+        return {tile for tile, changed in self.dirty.items()
+                if changed > version}
@@ -0,0 +1,640 @@
+import concurrent.futures
+import heapq
+import math
+import threading
+from collections import OrderedDict, deque
+from multiprocessing import shared_memory
+
+from pymunk import Vec2d
+
+# Offsets of the four neighbours of a tile, in the order the Ai visits them.
+NEIGHBOR_DELTAS = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+
+# Box types a tank can drive through, with and without metal boxes.
+PASSABLE = (0, 2)
+PASSABLE_METAL = (0, 2, 3)
+
+# Number of tiles a distance field search expands between two yields
+FIELD_SLICE = 16
+
+# Number of tiles the breadth first search of the ai expands between two
+# checks of the time budget
+SEARCH_SLICE = 64
+
+
+def rebuild_path(parents, node):
+    """
+    Follows the parents back from node to the start node, whose parent is
+    None, and returns the path, excluding the start node, as a deque of
+    Vec2d.
+    """
+    path = deque()
+    while parents[node] != None:
+        path.appendleft(Vec2d(node[0], node[1]))
+        node = parents[node]
+    return path
+
+
+def search_breadth_first(grid, start, target, allow_metal = False,
+                         out_of_time = None):
+    """
+    A generator that runs the breadth first search of the ai from start
+    to target in the grid, and yields before every slice of SEARCH_SLICE
+    tiles while out_of_time() is true. The parent of every visited tile is
+    stored, the path is rebuilt once the target has been found. Returns the
+    path, excluding the start, as a deque of Vec2d, empty if no path is
+    found, and the number of expanded tiles.
+    """
+    width  = grid.width
+    height = grid.height
+    cells  = grid.cells
+    passable = PASSABLE_METAL if allow_metal else PASSABLE
+    start  = (start[0], start[1])
+    target = (target[0], target[1])
+
+    queue = deque([start])
+    parents = {start: None}
+    expansions = 0
+    while queue:
+        if out_of_time != None and expansions % SEARCH_SLICE == 0:
+            while out_of_time():
+                yield
+        node = queue.popleft()
+        expansions += 1
+        if node == target:
+            return rebuild_path(parents, node), expansions
+
+        x, y = node
+        for dx, dy in NEIGHBOR_DELTAS:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < width and 0 <= ny < height \
+                and (nx, ny) not in parents \
+                and cells[ny * width + nx] in passable:
+                parents[(nx, ny)] = node
+                queue.append((nx, ny))
+    return deque(), expansions
+
+
+def breadth_first_search(grid, start, target, allow_metal = False):
+    """
+    Runs search_breadth_first to the end, and returns the path and the
+    number of expanded tiles.
+    """
+    search = search_breadth_first(grid, start, target, allow_metal)
+    try:
+        while True:
+            next(search)
+    except StopIteration as done:
+        return done.value
+
+
+class DistanceFields:
+    """
+    Distance fields (flow fields) shared by all the ai tanks. A field is
+    built with a single reverse breadth first search from a target tile and
+    stores the number of steps from every tile to that target, so that any
+    tank can read its next step in constant time. A field can be built a
+    slice at a time with prepare_field, see Ai.search_shortest_path.
+    """
+
+    def __init__(self, grid, max_fields = 32):
+        """
+        Takes the occupancy.OccupancyGrid to search and the number of fields
+        to keep before the least recently used one is dropped.
+        """
+        self.grid       = grid
+        self.max_fields = max_fields
+        self.version    = grid.version
+        self.fields     = OrderedDict()
+        # Searches of the fields being built by prepare_field, by key
+        self.building   = {}
+        self.searches   = 0
+        self.expansions = 0
+
+
+    def key(self, target, allow_metal):
+        """ Returns the key of the field for the target in self.fields. """
+        # Fields built before the grid changed are of no use anymore
+        if self.version != self.grid.version:
+            self.version = self.grid.version
+            self.fields.clear()
+            self.building.clear()
+        return (self.version, (target[0], target[1]), allow_metal)
+
+
+    def get_field(self, target, allow_metal = False):
+        """
+        Returns the distance field for the target tile, a flat list indexed
+        by y * width + x where None marks tiles that can't reach the target.
+        """
+        key = self.key(target, allow_metal)
+        field = self.fields.get(key)
+        if field == None:
+            field = self.build_field(target, allow_metal)
+            self.building.pop(key, None)
+            self.keep(key, field)
+        else:
+            self.fields.move_to_end(key)
+        return field
+
+
+    def keep(self, key, field):
+        """ Keeps the field, dropping the least recently used one if full. """
+        self.fields[key] = field
+        if len(self.fields) > self.max_fields:
+            self.fields.popitem(last = False)
+
+
+    def prepare_field(self, target, allow_metal = False, out_of_time = None):
+        """
+        A generator that builds the field for the target tile, unless it is
+        kept already, and yields before every slice of FIELD_SLICE tiles
+        while out_of_time() is true. The search of a field is shared, so a
+        field left half built by one caller is continued by the next one.
+        """
+        while True:
+            key = self.key(target, allow_metal)
+            if key in self.fields:
+                return
+            if out_of_time != None and out_of_time():
+                yield
+                continue
+            search = self.building.get(key)
+            if search == None:
+                search = self.search_field(target, allow_metal)
+                self.building[key] = search
+            try:
+                next(search)
+            except StopIteration as done:
+                del self.building[key]
+                self.keep(key, done.value)
+
+
+    def build_field(self, target, allow_metal):
+        """ Runs the reverse breadth first search from the target tile. """
+        search = self.search_field(target, allow_metal)
+        try:
+            while True:
+                next(search)
+        except StopIteration as done:
+            return done.value
+
+
+    def search_field(self, target, allow_metal):
+        """
+        A generator that runs the reverse breadth first search from the
+        target tile, yields after every FIELD_SLICE tiles and returns the
+        field.
+        """
+        self.searches += 1
+        width  = self.grid.width
+        height = self.grid.height
+        cells  = self.grid.cells
+        passable = PASSABLE_METAL if allow_metal else PASSABLE
+        field = [None] * (width * height)
+
+        tx, ty = target[0], target[1]
+        if not (0 <= tx < width and 0 <= ty < height) \
+            or cells[ty * width + tx] not in passable:
+            return field
+
+        field[ty * width + tx] = 0
+        queue = deque([(tx, ty)])
+        searched = 0
+        while queue:
+            x, y = queue.popleft()
+            self.expansions += 1
+            distance = field[y * width + x] + 1
+            for dx, dy in NEIGHBOR_DELTAS:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < width and 0 <= ny < height \
+                    and field[ny * width + nx] == None:
+                    # Every tile next to a reachable one can step onto it,
+                    # but we can only continue through tiles we can enter.
+                    field[ny * width + nx] = distance
+                    if cells[ny * width + nx] in passable:
+                        queue.append((nx, ny))
+            searched += 1
+            if searched % FIELD_SLICE == 0:
+                yield
+        return field
+
+
+    def next_tile(self, tile, target, allow_metal = False, random = None):
+        """
+        Returns the neighbour of tile that is one step closer to the target,
+        or None if the target is unreachable or already reached. If several
+        are, the first one is taken, or one picked with random, a
+        random.Random, if given.
+        """
+        width  = self.grid.width
+        height = self.grid.height
+        field = self.get_field(target, allow_metal)
+        x, y = tile[0], tile[1]
+        if not (0 <= x < width and 0 <= y < height):
+            return None
+        distance = field[y * width + x]
+        if distance == None or distance == 0:
+            return None
+
+        passable = PASSABLE_METAL if allow_metal else PASSABLE
+        closer = []
+        for dx, dy in NEIGHBOR_DELTAS:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < width and 0 <= ny < height \
+                and field[ny * width + nx] == distance - 1 \
+                and self.grid.cells[ny * width + nx] in passable:
+                if random == None:
+                    return (nx, ny)
+                closer.append((nx, ny))
+        if not closer:
+            return None
+        return random.choice(closer)
+
+
+    def find_shortest_path(self, start, target, allow_metal = False,
+                           random = None):
+        """
+        Follows the field from start and returns the path to target,
+        excluding the start, as a deque of Vec2d. Returns an empty deque if
+        no path is found. Among paths of the same length, one is picked
+        with random if given, see next_tile.
+        """
+        path = deque()
+        tile = self.next_tile(start, target, allow_metal, random)
+        while tile != None:
+            path.append(Vec2d(tile[0], tile[1]))
+            tile = self.next_tile(tile, target, allow_metal, random)
+        return path
+
+
+class IncrementalPlanner:
+    """
+    A shortest path planner using D* Lite. The search runs backwards from
+    the target, so when the tank moves or a tile changes only the part of
+    the search tree that is affected gets repaired. Tiles that changed in
+    the occupancy.OccupancyGrid are picked up before every search, or can be
+    reported directly with tile_changed.
+    """
+
+    def __init__(self, grid):
+        self.grid       = grid
+        self.version    = grid.version
+        self.searches   = {}
+        self.expansions = 0
+
+
+    def tile_changed(self, x, y):
+        """ Notifies every running search that the tile (x, y) changed. """
+        for search in self.searches.values():
+            search.tile_changed(x, y)
+
+
+    def find_shortest_path(self, start, target, allow_metal = False):
+        """
+        Returns the path from start to target, excluding the start, as a
+        deque of Vec2d. Returns an empty deque if no path is found.
+        """
+        if self.version != self.grid.version:
+            for x, y in self.grid.dirty_since(self.version):
+                self.tile_changed(x, y)
+            self.version = self.grid.version
+
+        target = (target[0], target[1])
+        search = self.searches.get(allow_metal)
+        if search == None or search.goal != target:
+            search = DStarLite(self, target, allow_metal)
+            self.searches[allow_metal] = search
+        return search.find_path((start[0], start[1]))
+
+
+class DStarLite:
+    """
+    The search state of an IncrementalPlanner for one target tile. Moving
+    onto a tile costs one step if it is passable and is impossible
+    otherwise, so a changed tile only changes the edges that lead to it.
+    """
+
+    def __init__(self, planner, goal, allow_metal):
+        self.planner    = planner
+        self.grid       = planner.grid
+        self.goal       = goal
+        self.passable   = PASSABLE_METAL if allow_metal else PASSABLE
+        self.g          = {}
+        self.rhs        = {goal: 0}
+        self.open       = {}
+        self.heap       = []
+        self.km         = 0
+        self.last_start = None
+
+
+    def heuristic(self, a, b):
+        """ Manhattan distance between two tiles. """
+        return abs(a[0] - b[0]) + abs(a[1] - b[1])
+
+
+    def neighbors(self, tile):
+        """ Returns the neighbours of the tile that are inside the map. """
+        x, y = tile
+        width, height = self.grid.width, self.grid.height
+        return [(x + dx, y + dy) for dx, dy in NEIGHBOR_DELTAS
+                if 0 <= x + dx < width and 0 <= y + dy < height]
+
+
+    def cost(self, tile):
+        """ The cost of moving onto tile from one of its neighbours. """
+        if self.grid.boxAt(tile[0], tile[1]) in self.passable:
+            return 1
+        return math.inf
+
+
+    def calculate_key(self, tile):
+        """ Returns the priority of tile in the open list. """
+        g = min(self.g.get(tile, math.inf), self.rhs.get(tile, math.inf))
+        return (g + self.heuristic(self.start, tile) + self.km, g)
+
+
+    def best_rhs(self, tile):
+        """ One step lookahead of the distance from tile to the goal. """
+        return min([self.cost(n) + self.g.get(n, math.inf)
+                    for n in self.neighbors(tile)], default = math.inf)
+
+
+    def update_vertex(self, tile):
+        """ Puts tile in the open list if, and only if, it is inconsistent. """
+        if tile != self.goal:
+            self.rhs[tile] = self.best_rhs(tile)
+        if self.g.get(tile, math.inf) != self.rhs.get(tile, math.inf):
+            key = self.calculate_key(tile)
+            self.open[tile] = key
+            heapq.heappush(self.heap, (key, tile))
+        else:
+            self.open.pop(tile, None)
+
+
+    def top(self):
+        """ Returns the open tile with the lowest key, dropping stale ones. """
+        while self.heap:
+            key, tile = self.heap[0]
+            if self.open.get(tile) == key:
+                return key, tile
+            heapq.heappop(self.heap)
+        return (math.inf, math.inf), None
+
+
+    def compute_shortest_path(self):
+        """ Expands inconsistent tiles until the start is consistent. """
+        while True:
+            key, tile = self.top()
+            start_g = self.g.get(self.start, math.inf)
+            start_rhs = self.rhs.get(self.start, math.inf)
+            if tile == None or (key >= self.calculate_key(self.start)
+                                and start_rhs == start_g):
+                return
+            self.planner.expansions += 1
+
+            new_key = self.calculate_key(tile)
+            if key < new_key:
+                self.open[tile] = new_key
+                heapq.heappush(self.heap, (new_key, tile))
+            elif self.g.get(tile, math.inf) > self.rhs.get(tile, math.inf):
+                # Overconsistent, the distance got shorter
+                self.g[tile] = self.rhs[tile]
+                del self.open[tile]
+                for neighbor in self.neighbors(tile):
+                    self.update_vertex(neighbor)
+            else:
+                # Underconsistent, the distance got longer
+                self.g[tile] = math.inf
+                self.update_vertex(tile)
+                for neighbor in self.neighbors(tile):
+                    self.update_vertex(neighbor)
+
+
+    def tile_changed(self, x, y):
+        """ Repairs the edges leading onto the changed tile. """
+        for neighbor in self.neighbors((x, y)):
+            self.update_vertex(neighbor)
+
+
+    def find_path(self, start):
+        """ Replans from start and returns the path as a deque of Vec2d. """
+        if self.last_start == None:
+            self.start = start
+            self.heap = [(self.calculate_key(self.goal), self.goal)]
+            self.open = {self.goal: self.heap[0][0]}
+        elif start != self.last_start:
+            # The keys stay lower bounds if km grows with each move
+            self.km += self.heuristic(self.last_start, start)
+            self.start = start
+        self.last_start = start
+        self.compute_shortest_path()
+
+        path = deque()
+        tile = start
+        if self.g.get(tile, math.inf) == math.inf:
+            return path
+        while tile != self.goal:
+            # Follow the neighbour with the lowest cost to the goal
+            tile = min(self.neighbors(tile),
+                       key = lambda n: self.cost(n) + self.g.get(n, math.inf))
+            path.append(Vec2d(tile[0], tile[1]))
+        return path
+
+
+# Cost of driving onto each type of tile, wooden boxes have to be shot and
+# metal boxes pushed out of the way. Rock boxes can't be passed.
+TILE_COSTS = {0: 1, 2: 2, 3: 10}
+
+
+class AStarPlanner:
+    """
+    A shortest path planner using A* with a Manhattan heuristic. Every box
+    type has a cost, so a single search can weigh a short path through a
+    metal box against a long detour.
+    """
+
+    def __init__(self, grid, costs = TILE_COSTS):
+        """ Takes the occupancy.OccupancyGrid and the cost of each box type. """
+        self.grid       = grid
+        self.costs      = costs
+        self.expansions = 0
+
+
+    def find_shortest_path(self, start, target, allow_metal = False):
+        """
+        Returns the cheapest path from start to target, excluding the start,
+        as a deque of Vec2d. Metal boxes are always weighed by their cost,
+        so allow_metal is ignored. Returns an empty deque if no path is
+        found.
+        """
+        width  = self.grid.width
+        height = self.grid.height
+        cells  = self.grid.cells
+        costs  = self.costs
+        # Scale the heuristic so that it never overestimates the cost
+        min_cost = min(costs.values())
+        start  = (start[0], start[1])
+        tx, ty = target[0], target[1]
+
+        parents = {start: None}
+        best    = {start: 0}
+        # Ties are broken in favour of the tile closest to the target
+        heap    = [(0, 0, start)]
+        while heap:
+            f, h, node = heapq.heappop(heap)
+            g = best[node]
+            if f > g + h:
+                # A cheaper way to this tile was found after it was queued
+                continue
+            if node == (tx, ty):
+                return rebuild_path(parents, node)
+            self.expansions += 1
+
+            x, y = node
+            for dx, dy in NEIGHBOR_DELTAS:
+                nx, ny = x + dx, y + dy
+                if not (0 <= nx < width and 0 <= ny < height):
+                    continue
+                cost = costs.get(cells[ny * width + nx])
+                if cost == None:
+                    continue
+                neighbor = (nx, ny)
+                new_g = g + cost
+                if new_g < best.get(neighbor, math.inf):
+                    best[neighbor] = new_g
+                    parents[neighbor] = node
+                    h = (abs(nx - tx) + abs(ny - ty)) * min_cost
+                    heapq.heappush(heap, (new_g + h, h, neighbor))
+        return deque()
+
+
+class GridSnapshot:
+    """ A read only copy of the box types of an occupancy.OccupancyGrid. """
+
+    def __init__(self, width, height, cells):
+        self.width  = width
+        self.height = height
+        self.cells  = cells
+
+
+    def boxAt(self, x, y):
+        """ Return the type of the box at coordinates (x, y). """
+        return self.cells[y * self.width + x]
+
+
+# Snapshots attached to by this worker process, by shared memory name.
+worker_snapshots = OrderedDict()
+
+
+def plan_in_worker(name, width, height, start, target, allow_metal):
+    """
+    Runs in a worker process of a PlannerPool. Runs breadth_first_search
+    in the grid snapshot stored in the named shared memory block.
+    """
+    snapshot = worker_snapshots.get(name)
+    if snapshot == None:
+        memory = shared_memory.SharedMemory(name)
+        cells = memory.buf[:width * height].cast("b")
+        snapshot = (memory, GridSnapshot(width, height, cells))
+        worker_snapshots[name] = snapshot
+        if len(worker_snapshots) > 4:
+            old_memory, old_snapshot = worker_snapshots.popitem(last = False)[1]
+            old_snapshot.cells.release()
+            old_memory.close()
+
+    return breadth_first_search(snapshot[1], start, target, allow_metal)
+
+
+class PlannerPool:
+    """
+    Plans paths in a pool of worker processes, so that the game can go on
+    while they search. The grid is copied into a shared memory block once
+    per grid version, and requests only carry the name of that block.
+    """
+
+    def __init__(self, grid, workers = None):
+        """ Takes the occupancy.OccupancyGrid and the number of processes. """
+        self.grid       = grid
+        self.executor   = concurrent.futures.ProcessPoolExecutor(workers)
+        self.expansions = 0
+        # Shared memory block and number of pending requests, by version.
+        # The requests are counted down on a thread of the executor, so
+        # the counts and the expansions are only changed holding the lock.
+        self.snapshots  = {}
+        self.lock       = threading.Lock()
+
+
+    def snapshot(self):
+        """ Returns the shared memory block holding the current grid. """
+        version = self.grid.version
+        if version not in self.snapshots:
+            cells = self.grid.cells.tobytes()
+            memory = shared_memory.SharedMemory(create = True,
+                                                size = len(cells))
+            memory.buf[:len(cells)] = cells
+            self.snapshots[version] = [memory, 0]
+            self.release_snapshots()
+        return self.snapshots[version]
+
+
+    def release_snapshots(self):
+        """ Removes the blocks of old versions that no request is using. """
+        with self.lock:
+            for version in list(self.snapshots):
+                memory, pending = self.snapshots[version]
+                if version != self.grid.version and pending == 0:
+                    memory.close()
+                    memory.unlink()
+                    del self.snapshots[version]
+
+
+    def submit(self, start, target, allow_metal = False):
+        """
+        Asks a worker for the path from start to target. Returns a
+        concurrent.futures.Future of the path, a deque of Vec2d that
+        excludes the start, and the number of tiles the worker expanded.
+        """
+        snapshot = self.snapshot()
+        with self.lock:
+            snapshot[1] += 1
+        try:
+            future = self.executor.submit(
+                plan_in_worker, snapshot[0].name, self.grid.width,
+                self.grid.height, (start[0], start[1]),
+                (target[0], target[1]), allow_metal
+            )
+        except Exception:
+            with self.lock:
+                snapshot[1] -= 1
+            raise
+        result = concurrent.futures.Future()
+
+        def done(future):
+            with self.lock:
+                snapshot[1] -= 1
+            try:
+                path, expansions = future.result()
+            except Exception as error:
+                result.set_exception(error)
+                return
+            with self.lock:
+                self.expansions += expansions
+            result.set_result((path, expansions))
+
+        future.add_done_callback(done)
+        return result
+
+
+    def find_shortest_path(self, start, target, allow_metal = False):
+        """ Like submit, but waits for the path and returns it. """
+        return self.submit(start, target, allow_metal).result()[0]
+
+
+    def shutdown(self):
+        """ Stops the worker processes and frees the shared memory. """
+        self.executor.shutdown()
+        for memory, pending in self.snapshots.values():
+            memory.close()
+            memory.unlink()
+        self.snapshots.clear()
@@ -0,0 +1,197 @@
+import json
+import time
+from collections import deque
+
+
+class TickProfiler:
+    """
+    Times the phases of every tick, and every ai within the decide phase.
+    The main loop calls start_tick() and end_tick() around a tick and
+    mark() after each phase, which is charged the time since the previous
+    mark. When disabled every call returns at once, and enabling or
+    disabling takes effect at the start of the next tick.
+    """
+
+    def __init__(self, window = 100, max_trace_events = 1000000):
+        """
+        The rolling statistics cover the last window ticks. At most
+        max_trace_events are kept while tracing.
+        """
+        self.enabled = False
+        self.active = False
+        self.window = window
+        self.max_trace_events = max_trace_events
+
+        # -- Times in ms of the recent ticks, per phase and per ai
+        self.tick_ms = deque(maxlen=window)
+        self.history = {}
+        self.ai_names = {}
+        # Total ms per phase and number of ticks since the last reset()
+        self.totals = {}
+        self.ticks = 0
+
+        # -- Chrome trace events, a list while tracing
+        self.trace = None
+        self.origin = time.perf_counter()
+
+        # -- File the rolling statistics are appended to every window ticks
+        self.stats_file = None
+
+        # -- Names of the values given to count(), which are not times
+        self.counters = set()
+
+        self.tick_start = self.last = self.ai_last = 0
+        self.current = {}
+        self.font = None
+
+
+    def toggle(self):
+        """ Enables the profiler if disabled, and the other way around. """
+        self.enabled = not self.enabled
+
+
+    def reset(self):
+        """ Forgets all the times measured so far. """
+        self.tick_ms.clear()
+        self.history = {}
+        self.totals = {}
+        self.ticks = 0
+
+
+    def start_tick(self):
+        """ Call this at the start of every tick. """
+        self.active = self.enabled
+        if not self.active:
+            return
+        self.tick_start = self.last = self.ai_last = time.perf_counter()
+        self.current = {}
+
+
+    def mark(self, phase):
+        """ Charges the time since the previous mark to the phase. """
+        if not self.active:
+            return
+        now = time.perf_counter()
+        self.add(phase, self.last, now, 0)
+        self.last = self.ai_last = now
+
+
+    def mark_ai(self, ai_tank):
+        """ Charges the time since the previous ai to this ai. """
+        if not self.active:
+            return
+        now = time.perf_counter()
+        name = self.ai_names.get(ai_tank)
+        if name == None:
+            name = self.ai_names[ai_tank] = "ai %d" % len(self.ai_names)
+        self.add(name, self.ai_last, now, 1)
+        self.ai_last = now
+
+
+    def add(self, name, start, end, thread):
+        """
+        Adds a measured time to the current tick, and to the trace on the
+        given thread, 0 for the phases and 1 for the ai.
+        """
+        ms = (end - start) * 1000
+        self.current[name] = self.current.get(name, 0) + ms
+        if self.trace != None and len(self.trace) < self.max_trace_events:
+            self.trace.append({
+                "name": name, "ph": "X", "pid": 0, "tid": thread,
+                "ts": (start - self.origin) * 1000000,
+                "dur": (end - start) * 1000000,
+            })
+
+
+    def count(self, name, value):
+        """ Records a value of the current tick, such as a number of bodies. """
+        if not self.active:
+            return
+        self.counters.add(name)
+        self.current[name] = value
+        if self.trace != None and len(self.trace) < self.max_trace_events:
+            self.trace.append({
+                "name": name, "ph": "C", "pid": 0,
+                "ts": (time.perf_counter() - self.origin) * 1000000,
+                "args": {name: value},
+            })
+
+
+    def end_tick(self):
+        """ Call this at the end of every tick. """
+        if not self.active:
+            return
+        self.tick_ms.append((time.perf_counter() - self.tick_start) * 1000)
+        for name, ms in self.current.items():
+            history = self.history.get(name)
+            if history == None:
+                history = self.history[name] = deque(maxlen=self.window)
+            history.append(ms)
+            self.totals[name] = self.totals.get(name, 0) + ms
+        self.ticks += 1
+
+        if self.stats_file != None and self.ticks % self.window == 0:
+            file = open(self.stats_file, "a")
+            file.write(json.dumps(self.stats()) + "\n")
+            file.close()
+
+
+    def stats(self):
+        """
+        Returns the mean and maximum ms of the tick and of every phase and
+        ai over the recent ticks, as a dict of name to (mean, max). The
+        counters are included with their mean and maximum values.
+        """
+        stats = {}
+        for name, history in [("tick", self.tick_ms)] \
+                + list(self.history.items()):
+            if history:
+                stats[name] = (sum(history) / len(history), max(history))
+        return stats
+
+
+    def start_trace(self):
+        """ Starts recording trace events. """
+        self.trace = []
+
+
+    def export_trace(self, file_name):
+        """
+        Writes the recorded events as Chrome trace event JSON, which can
+        be opened in chrome://tracing or Perfetto, and stops tracing.
+        """
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": 0, "tid": 0,
+             "args": {"name": "phases"}},
+            {"name": "thread_name", "ph": "M", "pid": 0, "tid": 1,
+             "args": {"name": "ai"}},
+        ] + (self.trace or [])
+        file = open(file_name, "w")
+        json.dump({"traceEvents": events}, file)
+        file.close()
+        self.trace = None
+
+
+    def draw_hud(self, screen, fps):
+        """
+        Draws the mean ms of the phases and the frame rate, and returns the
+        rectangle of the screen that was drawn.
+        """
+        import pygame
+        if self.font == None:
+            self.font = pygame.font.SysFont(None, 18)
+        font = self.font
+        lines = ["%.0f FPS" % fps]
+        for name, (mean, peak) in self.stats().items():
+            if name in self.counters:
+                lines.append("%-12s %6.0f" % (name, mean))
+            elif not name.startswith("ai "):
+                lines.append("%-12s %6.2f ms  max %6.2f" % (name, mean, peak))
+
+        height = font.get_linesize()
+        panel = pygame.Surface((220, height * len(lines) + 8)).convert_alpha()
+        panel.fill((0, 0, 0, 160))
+        for i, line in enumerate(lines):
+            panel.blit(font.render(line, True, (255, 255, 255)),
+                       (4, 4 + i * height))
+        return screen.blit(panel, (0, 0))
@@ -0,0 +1,370 @@
+import assets
+import gameobjects
+import pygame
+try:
+    import numpy
+    from pymunk import batch
+except ImportError:
+    numpy = None
+
+# In dirty rectangle mode, the whole screen is updated when the rectangles
+# that changed add up to more than this fraction of it
+FULL_UPDATE_FRACTION = 0.5
+
+
+def tile(surface, image):
+    """
+    Covers the surface with copies of the image. The first row is filled
+    by copying what is already drawn to the right of it, doubling its
+    width every time, and then the rows the same way downwards, so it
+    takes a few blits whatever the size of the surface.
+    """
+    width, height = surface.get_size()
+    tile_width, tile_height = image.get_size()
+    surface.blit(image, (0, 0))
+    filled = tile_width
+    while filled < width:
+        surface.blit(surface, (filled, 0), (0, 0, filled, tile_height))
+        filled *= 2
+    filled = tile_height
+    while filled < height:
+        surface.blit(surface, (0, filled), (0, 0, width, filled))
+        filled *= 2
+
+
+def fill_outside(surface, rects, color):
+    """
+    Fills the surface with the color, but the rectangles. The surface is
+    cut into horizontal bands at the top and bottom of every rectangle,
+    and the gaps between the rectangles are filled band by band.
+    """
+    width, height = surface.get_size()
+    edges = sorted({0, height} | {min(max(edge, 0), height) for rect in rects
+                                  for edge in (rect.top, rect.bottom)})
+    for top, bottom in zip(edges, edges[1:]):
+        x = 0
+        for left, right in sorted((rect.left, rect.right) for rect in rects
+                                  if rect.top < bottom and rect.bottom > top):
+            if left > x:
+                surface.fill(color, (x, top, left - x, bottom - top))
+            x = max(x, right)
+        if x < width:
+            surface.fill(color, (x, top, width - x, bottom - top))
+
+
+class FogOfWar:
+    """
+    Covers the screen in black but for a circle around every source of
+    visibility. The holes are cut in a mask that is kept from a frame to
+    the next, where only the holes of the previous frame are filled back
+    and the new ones cut. The screen is filled in black around the holes
+    and the mask is only blended where the holes are.
+    """
+
+    def __init__(self, size, radius = 100):
+        """ Takes the size of the screen and the radius of the holes. """
+        self.radius = radius
+        self.mask = pygame.Surface(size, pygame.SRCALPHA)
+        self.mask.fill((0, 0, 0, 255))
+        # -- The rectangles of the holes in the mask, and whether the fog
+        #    was drawn in the previous frame
+        self.holes = []
+        self.visible = False
+
+
+    def areas(self, sources):
+        """
+        Returns the rectangles of the screen that the holes around the
+        positions in sources will show. What was drawn there before is
+        under the fog, so they have to be drawn again, see
+        Renderer.redraw_rect.
+        """
+        size = 2 * self.radius + 2
+        return [pygame.Rect(int(x) - self.radius - 1, int(y) - self.radius - 1,
+                            size, size) for x, y in sources]
+
+
+    def draw(self, screen, sources):
+        """
+        Draws the fog over the screen, with a hole around every position
+        in sources, and returns the rectangles of the screen that changed
+        since the previous frame.
+        """
+        for rect in self.holes:
+            self.mask.fill((0, 0, 0, 255), rect)
+        previous = self.holes
+        self.holes = [
+            pygame.draw.circle(self.mask, (0, 0, 0, 0), position, self.radius)
+            for position in sources
+        ]
+
+        fill_outside(screen, self.holes, (0, 0, 0))
+        for rect in self.holes:
+            screen.blit(self.mask, rect, rect)
+
+        if not self.visible:
+            self.visible = True
+            return [screen.get_rect()]
+        return previous + self.holes
+
+
+    def hide(self):
+        """ Call this when the fog is no longer drawn. """
+        for rect in self.holes:
+            self.mask.fill((0, 0, 0, 255), rect)
+        self.holes = []
+        self.visible = False
+
+
+class Renderer:
+    """
+    Draws a world in layers. The ground and the scenery of the world (see
+    GameObject.static) are drawn once onto a static layer, which is drawn
+    again only when scenery is added or removed. Every frame, the static
+    layer is copied to the screen and the actors are drawn over it, in the
+    order of their GameObject.layer, with one Surface.blits call. With
+    NumPy, the actors with a body are placed in bulk.
+    In dirty rectangle mode only the actors whose sprite or position
+    changed are drawn again, after copying the static layer over where
+    they were, and only those rectangles are updated on the display.
+    """
+
+    def __init__(self, world, ground, dirty_rects = False):
+        """
+        Takes the world to draw, the image of a tile of ground, and
+        whether to use dirty rectangles.
+        """
+        self.world = world
+        self.ground = ground
+        self.dirty_rects = dirty_rects
+        self.layer = None
+        self.scenery_version = None
+        # -- The sprite and rectangle of every actor, and the rectangles
+        #    given to mark(), as drawn in the previous frame
+        self.sprites = {}
+        self.marked = []
+        # -- The rectangles that changed since the previous frame, None if
+        #    the whole screen did
+        self.changed = None
+        self.redraw = True
+
+        # -- The body ids of the actors, by entity id, and the buffer the
+        #    bodies are read into
+        self.body_ids = {}
+        self.buffer = None
+        if numpy != None:
+            self.buffer = batch.Buffer()
+            self.fields = batch.BodyFields.BODY_ID \
+                | batch.BodyFields.POSITION | batch.BodyFields.ANGLE
+
+
+    def build_layer(self, size):
+        """ Draws the ground and the scenery onto the static layer. """
+        self.layer = pygame.Surface(size)
+        if pygame.display.get_surface() != None:
+            self.layer = self.layer.convert()
+        tile(self.layer, self.ground)
+        for obj in sorted(self.world.entities.scenery.values(),
+                          key=lambda obj: obj.layer):
+            obj.update_screen(self.layer)
+        self.scenery_version = self.world.entities.scenery_version
+
+
+    def draw(self, screen, alpha = 1.0):
+        """
+        Draws the world onto the screen, with the actors between the
+        previous and the current tick, see GameObject.update_screen.
+        """
+        entities = self.world.entities
+        if self.layer == None or self.layer.get_size() != screen.get_size() \
+                or self.scenery_version != entities.scenery_version:
+            self.build_layer(screen.get_size())
+            self.redraw = True
+
+        if gameobjects.DEBUG:
+            # Some objects draw more than their sprite, so one by one
+            screen.blit(self.layer, (0, 0))
+            for obj in sorted(entities.actors.values(),
+                              key=lambda obj: obj.layer):
+                obj.update_screen(screen, alpha)
+            self.invalidate()
+            self.marked = []
+            return
+
+        sprites = self.actor_sprites(alpha)
+        if self.redraw or not self.dirty_rects:
+            screen.blit(self.layer, (0, 0))
+            screen.blits(list(sprites.values()), False)
+            self.changed = None
+        else:
+            self.changed = self.draw_changes(screen, sprites)
+        self.sprites = sprites
+        self.marked = []
+        self.redraw = False
+
+
+    def actor_sprites(self, alpha):
+        """
+        Returns the sprite and the rectangle of the screen of every actor,
+        by entity id, in the order they are drawn: layer by layer, and in
+        a layer the objects with a body first.
+        """
+        layers = {}
+        for item in self.world.entities.actors.items():
+            layer = layers.get(item[1].layer)
+            if layer == None:
+                layer = layers[item[1].layer] = ([], [])
+            layer[not hasattr(item[1], "body")].append(item)
+
+        sprites = {}
+        bodies = None
+        body_ids = {}
+        for number in sorted(layers):
+            with_body, without_body = layers[number]
+            if with_body and numpy != None:
+                if bodies == None:
+                    bodies = self.read_bodies()
+                self.body_sprites(with_body, alpha, bodies, body_ids, sprites)
+            else:
+                without_body = with_body + without_body
+            for entity_id, obj in without_body:
+                sprites[entity_id] = obj.screen_sprite(alpha)
+        # Forget the destroyed actors
+        self.body_ids = body_ids
+        return sprites
+
+
+    def read_bodies(self):
+        """
+        Returns the ids of the bodies of the space, the order that sorts
+        them, and their positions and angles as an array of rows of x, y
+        and angle.
+        """
+        self.buffer.clear()
+        batch.get_space_bodies(self.world.space, self.fields, self.buffer)
+        ids = numpy.frombuffer(self.buffer.int_buf(), dtype=numpy.int64)
+        data = numpy.frombuffer(self.buffer.float_buf(), dtype=numpy.float64)
+        return ids, numpy.argsort(ids), data.reshape(len(ids), 3)
+
+
+    def body_sprites(self, objects, alpha, bodies, body_ids, sprites):
+        """
+        Adds the sprite and rectangle of the screen of the objects, which
+        have a body, to sprites. The positions and angles are interpolated
+        and converted to the screen for all of them at once, as in
+        GamePhysicsObject.screen_position and screen_orientation.
+        """
+        for entity_id, obj in objects:
+            body_id = self.body_ids.get(entity_id)
+            if body_id == None:
+                body_id = obj.body.id
+            body_ids[entity_id] = body_id
+        wanted = numpy.array([body_ids[entity_id] for entity_id, obj
+                              in objects], dtype=numpy.int64)
+        ids, order, data = bodies
+        positions = numpy.minimum(
+            numpy.searchsorted(ids, wanted, sorter=order), len(ids) - 1)
+        rows = order[positions]
+        current = data[rows]
+        found = (ids[rows] == wanted).tolist()
+
+        if alpha == 1.0:
+            state = current
+        else:
+            previous = numpy.array([
+                (obj.previous_position[0], obj.previous_position[1],
+                 obj.previous_angle) for entity_id, obj in objects
+            ]).reshape(-1, 3)
+            state = previous + (current - previous) * alpha
+        xs = (state[:, 0] * assets.TILE_SIZE).tolist()
+        ys = (state[:, 1] * assets.TILE_SIZE).tolist()
+        orientations = (-numpy.degrees(state[:, 2])).tolist()
+
+        rotate = gameobjects.rotation_cache.rotate
+        for (entity_id, obj), x, y, orientation, in_space in zip(
+                objects, xs, ys, orientations, found):
+            if not in_space:
+                sprites[entity_id] = obj.screen_sprite(alpha)
+                continue
+            sprite = rotate(obj.sprite, orientation)
+            width, height = sprite.get_size()
+            sprites[entity_id] = (sprite, pygame.Rect(
+                int(x - width / 2), int(y - height / 2), width, height))
+
+
+    def draw_changes(self, screen, sprites):
+        """
+        Draws the actors that changed since the previous frame, given the
+        sprite and rectangle of every actor, and returns the rectangles of
+        the screen that changed.
+        """
+        previous = self.sprites
+        restore = self.marked + [
+            rect for entity_id, (sprite, rect) in previous.items()
+            if sprites.get(entity_id) != (sprite, rect)
+        ]
+        changed = {entity_id for entity_id, drawn in sprites.items()
+                   if previous.get(entity_id) != drawn}
+
+        # -- The actors that did not change but overlap what is drawn again
+        #    are drawn again too, from the static layer up
+        still = [entity_id for entity_id in sprites
+                 if entity_id not in changed]
+        still_rects = [sprites[entity_id][1] for entity_id in still]
+        pending = restore + [sprites[entity_id][1] for entity_id in changed]
+        while pending and still:
+            hit = set()
+            for rect in pending:
+                hit.update(rect.collidelistall(still_rects))
+            pending = []
+            for index in hit:
+                if still[index] not in changed:
+                    changed.add(still[index])
+                    pending.append(still_rects[index])
+                    restore.append(still_rects[index])
+
+        screen.blits([(self.layer, rect, rect) for rect in restore], False)
+        drawn = screen.blits([drawn for entity_id, drawn in sprites.items()
+                              if entity_id in changed])
+        return restore + drawn
+
+
+    def mark(self, rect):
+        """
+        Adds a rectangle drawn over the world after draw(), such as a
+        panel, to the ones to update on the display, and to the ones to
+        draw again in the next frame.
+        """
+        self.marked.append(rect)
+        if self.changed != None:
+            self.changed.append(rect)
+
+
+    def redraw_rect(self, rect):
+        """ Makes the next draw() draw the rectangle again. """
+        self.marked.append(rect)
+
+
+    def invalidate(self):
+        """
+        Call this after drawing over the whole screen, the display is
+        updated entirely and the next frame is drawn from scratch.
+        """
+        self.changed = None
+        self.redraw = True
+
+
+    def update_display(self):
+        """
+        Updates the display with what was drawn since the previous frame,
+        only the rectangles that changed if there are not too many.
+        """
+        if self.changed == None:
+            pygame.display.flip()
+            return
+        width, height = pygame.display.get_surface().get_size()
+        area = sum(rect.width * rect.height for rect in self.changed)
+        if area > width * height * FULL_UPDATE_FRACTION:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.changed)
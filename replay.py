@@ -0,0 +1,340 @@
+"""
+Records the controls of the tanks during a match and replays them without
+a window, as fast as possible. The recording holds the map, the seed, the
+rates and sleep settings of the physics and, for every tick where the
+controls of some tank changed, one byte per tank with the
+Tank.actions bits. Checksums of the world are stored at intervals and
+compared while replaying. Run from the repository root, for example:
+
+    python replay.py match.ctfr
+    python replay.py match.ctfr --seek 3000
+    python replay.py --check "Map 1.txt" "Map 2.txt" "Map 3.txt" --runs 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+import time
+
+import engine
+import gameobjects
+import maps
+
+# -- File format: header, then records that start with a kind and a tick.
+#    The header ends with the physics, control and ai rates, the sleep time,
+#    0 as no body sleeps, the idle speed and whether the rocks are merged.
+MAGIC = b"CTFR"
+VERSION = 2
+HEADER = struct.Struct("<4sBBBHqIdddddB")
+RECORD = struct.Struct("<cI")
+CHECKSUM = struct.Struct("<I")
+
+INPUTS = b"I"
+CHECKSUM_RECORD = b"C"
+END = b"E"
+
+
+class InputRecorder:
+    """
+    Writes the controls of the tanks of a world to a file, tick by tick.
+    Set it as world.recorder before the first tick and call close() at the
+    end of the match. The world must be built with sleep_time = None, as
+    Chipmunk wakes bodies up in an order that depends on where they are
+    in memory, which a replay can't repeat.
+    """
+
+    def __init__(self, file_name, world, checksum_interval = 50):
+        if world.sleep_time != None:
+            raise ValueError("a world where bodies sleep can't be replayed")
+        self.file = open(file_name, "wb")
+        self.checksum_interval = checksum_interval
+        self.last_actions = bytes(len(world.tanks_list))
+
+        map_data = json.dumps(world.current_map.__dict__).encode()
+        players = sum(1 for tank in world.tanks_list if tank.ai == None)
+        self.file.write(HEADER.pack(
+            MAGIC, VERSION, players, len(world.tanks_list),
+            checksum_interval, world.seed, len(map_data),
+            world.physics_rate, world.control_rate, world.ai_rate,
+            0, world.idle_speed, world.merge_rocks
+        ))
+        self.file.write(map_data)
+
+
+    def record(self, world):
+        """ Called by the world at the end of every tick. """
+        actions = bytes(tank.actions for tank in world.tanks_list)
+        if actions != self.last_actions:
+            self.file.write(RECORD.pack(INPUTS, world.ticks) + actions)
+            self.last_actions = actions
+        if world.ticks % self.checksum_interval == 0:
+            self.file.write(RECORD.pack(CHECKSUM_RECORD, world.ticks))
+            self.file.write(CHECKSUM.pack(world.checksum()))
+
+
+    def close(self, world):
+        """ Marks the end of the match and closes the file. """
+        self.file.write(RECORD.pack(END, world.ticks))
+        self.file.close()
+
+
+def apply_actions(world, tank, actions):
+    """ Uses the controls of the tank given by the Tank.actions bits. """
+    Tank = gameobjects.Tank
+    if actions & Tank.STOP_MOVING:
+        tank.stop_moving()
+    if actions & Tank.ACCELERATE:
+        tank.accelerate()
+    elif actions & Tank.DECELERATE:
+        tank.decelerate()
+    if actions & Tank.STOP_TURNING:
+        tank.stop_turning()
+    if actions & Tank.TURN_LEFT:
+        tank.turn_left()
+    elif actions & Tank.TURN_RIGHT:
+        tank.turn_right()
+    if actions & Tank.SHOOT:
+        world.shoot(tank)
+
+
+class RecordedAi:
+    """
+    Takes the place of an Ai in the replayed world, and uses the recorded
+    controls of its tank at the point of the tick where the ai decides.
+    """
+
+    def __init__(self, replay, index, tank):
+        self.replay = replay
+        self.index = index
+        self.tank = tank
+        self.deadline = None
+
+
+    def decide(self):
+        apply_actions(self.replay.world, self.tank,
+                      self.replay.actions[self.index])
+
+
+class Replay:
+    """
+    Plays a recorded match again. The world is rebuilt from the map and
+    the settings in the recording, the player tanks get their controls
+    before every tick and the ai tanks get them from a RecordedAi, so the
+    ai is not run.
+    """
+
+    def __init__(self, file_name):
+        file = open(file_name, "rb")
+        data = file.read()
+        file.close()
+
+        magic, version = struct.unpack_from("<4sB", data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a recording" % file_name)
+        _, _, self.players, self.tank_count, self.checksum_interval, \
+            self.seed, map_size, self.physics_rate, self.control_rate, \
+            self.ai_rate, self.sleep_time, self.idle_speed, \
+            self.merge_rocks = HEADER.unpack_from(data)
+        self.sleep_time = self.sleep_time or None
+        self.merge_rocks = bool(self.merge_rocks)
+        offset = HEADER.size
+        map_data = json.loads(data[offset:offset + map_size])
+        offset += map_size
+        self.current_map = maps.Map(
+            map_data["name"], map_data["width"], map_data["height"],
+            map_data["boxes"], map_data["start_positions"],
+            map_data["flag_position"]
+        )
+
+        # -- The controls from the given ticks on, and the checksums
+        self.inputs = {}
+        self.checksums = {}
+        self.end = None
+        while self.end == None:
+            kind, tick = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if kind == INPUTS:
+                self.inputs[tick] = data[offset:offset + self.tank_count]
+                offset += self.tank_count
+            elif kind == CHECKSUM_RECORD:
+                self.checksums[tick] = CHECKSUM.unpack_from(data, offset)[0]
+                offset += CHECKSUM.size
+            else:
+                self.end = tick
+
+        self.world = None
+        self.restart()
+
+
+    def restart(self):
+        """ Goes back to the start of the match. """
+        if self.world != None:
+            self.world.close()
+        # Not deterministic, which would stop the bodies from sleeping if
+        # they did in the recorded match, but the ai is not run anyway
+        self.world = engine.World(
+            self.current_map, self.tank_count, headless = True,
+            ai_budget_ms = None, seed = self.seed,
+            physics_rate = self.physics_rate,
+            control_rate = self.control_rate, ai_rate = self.ai_rate,
+            sleep_time = self.sleep_time, idle_speed = self.idle_speed,
+            merge_rocks = self.merge_rocks
+        )
+        for i in range(self.players, self.tank_count):
+            self.world.ai_list.add(
+                RecordedAi(self, i, self.world.tanks_list[i]))
+        self.actions = bytes(self.tank_count)
+        self.verified = 0
+        # The ticks where the checksum did not match the recording
+        self.mismatches = []
+
+
+    def step(self):
+        """ Replays one tick, returns False at the end of the match. """
+        world = self.world
+        if world.ticks >= self.end:
+            return False
+        self.actions = self.inputs.get(world.ticks + 1, self.actions)
+        for i in range(self.players):
+            apply_actions(world, world.tanks_list[i], self.actions[i])
+        world.tick()
+
+        expected = self.checksums.get(world.ticks)
+        if expected != None:
+            self.verified += 1
+            if world.checksum() != expected:
+                self.mismatches.append(world.ticks)
+        return True
+
+
+    def seek(self, tick):
+        """ Replays up to the given tick, going back to the start if needed. """
+        if tick < self.world.ticks:
+            self.restart()
+        while self.world.ticks < tick and self.step():
+            pass
+
+
+def record_matches(map_names, seed, ticks, directory, deterministic = True):
+    """
+    Plays a match of ai tanks on every map, one after the other in this
+    process, and records each of them in the directory. If not
+    deterministic, the world is built as by ctf.py when it records.
+    Returns the file names of the recordings and the final checksums.
+    """
+    recordings = []
+    for i, map_name in enumerate(map_names):
+        world = engine.World(maps.load_map(map_name), 0, headless = True,
+                             seed = seed, deterministic = deterministic,
+                             sleep_time = None)
+        file_name = os.path.join(directory, "%d.ctfr" % i)
+        world.recorder = InputRecorder(file_name, world)
+        for tick in range(ticks):
+            world.tick()
+        world.recorder.close(world)
+        world.close()
+        recordings.append((file_name, world.checksum()))
+    return recordings
+
+
+def replay_match(file_name):
+    """
+    Replays the recording to the end and returns the ticks where the
+    checksum differed, the number of checksums verified and the final
+    checksum.
+    """
+    replay = Replay(file_name)
+    replay.seek(replay.end)
+    replay.world.close()
+    return replay.mismatches, replay.verified, replay.world.checksum()
+
+
+def check(map_names, seed, ticks, runs):
+    """
+    Checks that matches are deterministic across processes. Every run
+    records a deterministic match on each map in a new process, and a
+    match with the settings of the game, and every recording is replayed
+    in a new process of its own. Returns the number of problems found:
+    replays whose checksums differ from the recording, and maps whose
+    final checksum of the deterministic match differs between runs.
+    """
+    os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+    context = multiprocessing.get_context("spawn")
+    problems = 0
+    finals = {}
+    for run in range(runs):
+        for deterministic in (True, False):
+            kind = "deterministic" if deterministic else "game"
+            with tempfile.TemporaryDirectory() as directory:
+                with context.Pool(1, maxtasksperchild=1) as pool:
+                    recordings = pool.apply(
+                        record_matches,
+                        (map_names, seed, ticks, directory, deterministic))
+                    for map_name, (file_name, checksum) in zip(map_names,
+                                                               recordings):
+                        mismatches, verified, replayed = pool.apply(
+                            replay_match, (file_name,))
+                        # The ai of the game depends on the speed of the
+                        # computer, only its replays are compared
+                        if deterministic:
+                            finals.setdefault(map_name, set()).add(checksum)
+                        if mismatches or replayed != checksum:
+                            problems += 1
+                            print("run %d, %s, %s: %d of %d checksums "
+                                  "differ" % (run, map_name, kind,
+                                              len(mismatches), verified))
+                        else:
+                            print("run %d, %s, %s: %d checksums verified, "
+                                  "final %08x" % (run, map_name, kind,
+                                                  verified, checksum))
+    for map_name, checksums in finals.items():
+        if len(checksums) > 1:
+            problems += 1
+            print("%s: the runs ended with %d different checksums" % (
+                map_name, len(checksums)))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("recording", nargs="?")
+    parser.add_argument("--seek", type=int, default=None,
+                        help="stop at this tick instead of the end")
+    parser.add_argument("--check", nargs="+", metavar="MAP",
+                        help="record and replay matches on these maps in "
+                             "new processes and compare the checksums")
+    parser.add_argument("--runs", type=int, default=4)
+    parser.add_argument("--ticks", type=int, default=3000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.check != None:
+        if check(args.check, args.seed, args.ticks, args.runs) > 0:
+            sys.exit(1)
+        return
+    if args.recording == None:
+        parser.error("a recording or --check is required")
+
+    replay = Replay(args.recording)
+    start = time.perf_counter()
+    replay.seek(replay.end if args.seek == None else args.seek)
+    elapsed = time.perf_counter() - start
+
+    world = replay.world
+    print("%s: tick %d of %d, %.0f ticks/s" % (
+        replay.current_map.name, world.ticks, replay.end,
+        world.ticks / elapsed))
+    print("scores %s, checksum %08x" % (
+        [tank.score for tank in world.tanks_list], world.checksum()))
+    if replay.mismatches:
+        print("%d of %d checksums differ, first at tick %d" % (
+            len(replay.mismatches), replay.verified, replay.mismatches[0]))
+    else:
+        print("%d checksums verified" % replay.verified)
+
+
+if __name__ == "__main__":
+    main()
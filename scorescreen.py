@@ -1,7 +1,6 @@
 import pygame
 import os
 import images
-import ctf
 
 tank_colours = ["Orange", "Blue", "White", "Yellow", "Red", "Gray"]
 tank_uni = ["LiU", "KTH", "Chalmers", "Skövde", "Uppsala", "Lund"]